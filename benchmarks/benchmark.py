@@ -0,0 +1,195 @@
+#!/usr/bin/python2
+# vim: et:ts=4:sw=4
+#
+# Maui Build
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+
+# Measure the overhead of builder.py itself, with stand-ins for the
+# SDK chroot, kickstarter, mic and sudo found in the fake directory.
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_DIR = os.path.join(BENCHMARKS_DIR, "fake")
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import builder
+from builderlib.buildstate import BuildState
+from builderlib.store import ObjectStore
+
+def git(args, cwd):
+    subprocess.check_call(["git", "-c", "user.name=Benchmark", "-c", "user.email=benchmark@localhost"] + args,
+                          cwd=cwd, stdout=open(os.devnull, "w"))
+
+def make_sources(workdir, files, file_size, targets):
+    # Upstream repository with @files files, cloned like the real checkout
+    upstream = os.path.join(workdir, "upstream")
+    os.makedirs(upstream)
+    data = b"x" * file_size
+    for i in range(files):
+        dirname = os.path.join(upstream, "dir%03d" % (i // 100))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, "file%05d" % i), "wb") as f:
+            f.write(data)
+    with open(os.path.join(upstream, "maui.yaml"), "w") as f:
+        f.write("".join(["%s\n" % target["name"] for target in targets]))
+    git(["init", "-q"], upstream)
+    git(["add", "."], upstream)
+    git(["commit", "-q", "-m", "Benchmark sources"], upstream)
+
+    sources = os.path.join(workdir, "sources")
+    git(["clone", "-q", upstream, sources], workdir)
+    return sources
+
+def timed(results, name, func, *args):
+    start = time.time()
+    result = func(*args)
+    results[name] = time.time() - start
+    return result
+
+def run_scenario(files, target_count, options):
+    workdir = tempfile.mkdtemp(prefix="mauibuild-benchmark-", dir=options.workdir)
+    try:
+        targets = [{"name": "bench-%d" % i, "config": "maui.yaml",
+                    "cache": "arch%d" % (i % options.caches)} for i in range(target_count)]
+        sources_dir = make_sources(workdir, files, options.file_size, targets)
+        build_dir = os.path.join(workdir, "buildroot")
+        publish_dir = os.path.join(workdir, "publish")
+        sdk_cmd = os.path.join(FAKE_DIR, "mer-sdk-chroot")
+
+        results = {}
+        timed(results, "resolve", builder.resolve, sources_dir)
+        commit = builder.sources_commit(sources_dir)
+        new_sources_dir = timed(results, "copy_sources", builder.copy_sources,
+                                sources_dir, build_dir, options.snapshot)
+        state = BuildState(os.path.join(build_dir, "state.json"))
+        builds = timed(results, "build", lambda: builder.build(targets, sdk_cmd, new_sources_dir,
+                       build_dir, state, commit, options.jobs, sdk_session=options.sdk_session))
+        # The fake sudo leaves images owned by us, so the build skipped
+        # the chown done after mic: run it on every image instead
+        timed(results, "chown", builder.chown, [b["path"] for b in builds])
+        store = ObjectStore(os.path.join(publish_dir, ".objects"))
+        timed(results, "publish", builder.publish, builds, publish_dir, store, state, options.zsync)
+        timed(results, "cleanup", shutil.rmtree, new_sources_dir)
+        results["total"] = sum(results.values())
+        return {"files": files, "targets": target_count, "phases": results}
+    finally:
+        shutil.rmtree(workdir)
+
+def version():
+    root = os.path.dirname(BENCHMARKS_DIR)
+    try:
+        output = subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=root)
+        return output.decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(previous, current, threshold):
+    # Print phases that got slower than @threshold percent
+    old = dict([((r["files"], r["targets"]), r["phases"]) for r in previous["results"]])
+    regressions = 0
+    print("Comparing %s with %s" % (previous["version"], current["version"]))
+    for result in current["results"]:
+        key = (result["files"], result["targets"])
+        if key not in old:
+            continue
+        for phase, seconds in sorted(result["phases"].items()):
+            before = old[key].get(phase)
+            if not before:
+                continue
+            change = 100.0 * (seconds - before) / before
+            flag = ""
+            if change > threshold:
+                flag = "  REGRESSION"
+                regressions += 1
+            print("  files=%-6d targets=%-3d %-12s %8.3fs -> %8.3fs (%+.1f%%)%s" %
+                  (key[0], key[1], phase, before, seconds, change, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark builder.py with a fake SDK")
+    parser.add_argument("--files", default="100,1000,10000",
+                        help="comma separated sizes of the sources tree")
+    parser.add_argument("--file-size", type=int, default=4096,
+                        help="size of each source file in bytes")
+    parser.add_argument("--targets", default="1,4",
+                        help="comma separated number of targets")
+    parser.add_argument("--caches", type=int, default=2,
+                        help="number of packages caches shared by targets")
+    parser.add_argument("--jobs", type=int, default=1, help="targets built at the same time")
+    parser.add_argument("--image-size", default="2G", help="apparent size of images")
+    parser.add_argument("--image-data", type=int, default=16, help="MiB actually written to images")
+    parser.add_argument("--snapshot", default="auto", help="snapshot strategy")
+    parser.add_argument("--sdk-session", action="store_true",
+                        help="enter the SDK chroot once instead of for each command")
+    parser.add_argument("--chroot-setup", type=float, default=0,
+                        help="seconds spent entering the SDK chroot")
+    parser.add_argument("--zsync", action="store_true", help="create zsync files when publishing")
+    parser.add_argument("--workdir", default=None, help="where to create temporary files")
+    parser.add_argument("--output", default=None, help="JSON file for results")
+    parser.add_argument("--compare", default=None, help="JSON file with previous results")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="percentage above which a slower phase is a regression")
+    options = parser.parse_args()
+
+    os.environ["PATH"] = FAKE_DIR + os.pathsep + os.environ["PATH"]
+    os.environ["BENCH_IMAGE_SIZE"] = options.image_size
+    os.environ["BENCH_IMAGE_DATA"] = str(options.image_data)
+    os.environ["BENCH_CHROOT_SETUP"] = str(options.chroot_setup)
+
+    results = []
+    for files in [int(n) for n in options.files.split(",")]:
+        for target_count in [int(n) for n in options.targets.split(",")]:
+            results.append(run_scenario(files, target_count, options))
+
+    data = {"version": version(), "host": socket.gethostname(),
+            "date": datetime.datetime.now().isoformat(),
+            "options": vars(options), "results": results}
+
+    output = options.output
+    if output is None:
+        output = os.path.join(BENCHMARKS_DIR, "results", "%s-%s.json" %
+                              (data["version"], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, "w") as f:
+        f.write(json.dumps(data, indent=4, sort_keys=True))
+    print("Results saved to %s" % output)
+
+    for result in results:
+        print("files=%-6d targets=%-3d %s" % (result["files"], result["targets"],
+              " ".join(["%s=%.3fs" % item for item in sorted(result["phases"].items())])))
+
+    if options.compare:
+        with open(options.compare, "r") as f:
+            previous = json.loads(f.read())
+        if compare(previous, data, options.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -22,22 +22,113 @@
 import os
 import sys
 import json
+import time
 import shutil
+import argparse
+import binascii
 import datetime
+import threading
 
-from builderlib.logger import Logger
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+from builderlib.logger import Logger, configure as configure_logger
 from builderlib.subprocess_helpers import *
-from builderlib.fileutil import ensure_parent_dir
+from builderlib.fileutil import ensure_parent_dir, tree_linkcopy, parse_size, lock_file
+from builderlib.buildstate import BuildState, fingerprint
+from builderlib.journal import Journal
+from builderlib.history import BuildHistory
+from builderlib.scheduler import Scheduler
+from builderlib.snapshot import create_snapshot
+from builderlib.gitutil import git_output
+from builderlib.kickstart import generate_kickstarts
+from builderlib.store import ObjectStore
+from builderlib.checksum import md4_available
+from builderlib.index import SnapshotIndex
+from builderlib.cache import PackageCache
+from builderlib.prewarm import Prewarmer
+from builderlib.trace import tracer, span
+from builderlib.daemon import BuildDaemon, send_command
+from builderlib.diskspace import SpaceAdmission, tree_size
+from builderlib.cleanup import prune_snapshots, remove_orphans, remove_stale
+from builderlib.staging import StagingArea, filesystem_type, write_mic_config
+from builderlib.resources import ResourceProfile, cgroup2_available, usage_report
+from builderlib.compress import Compressor, parse_compression
+from builderlib.sources import SourceMirrors, parse_sources, remote_commits, combined_commit
+from builderlib.workers import WorkerPool, WorkerError, BuildError, serve, start_local_workers, parse_address
 
 logger = Logger()
 
-def chown(path):
+def chown(paths):
     s = "%d:%d" % (os.getuid(), os.getgid())
-    run_sync(["sudo", "chown", "-R", s, path])
+    return run_sync(["sudo", "chown", "-R", s] + list(paths), fatal_on_error=False)
 
-def readconf():
+class ImageFinisher(object):
+    # Rectify owner of files created with sudo and compress images in
+    # the background, so that the next target can be built in the
+    # meantime
+
+    def __init__(self, journal=None, compressor=None, compression=None):
+        self._journal = journal
+        self._compressor = compressor
+        self._compression = compression or {}
+        self._threads = []
+        self._failed = []
+
+    def _done(self, stage, name):
+        if self._journal is not None and name is not None:
+            self._journal.done(stage, name)
+
+    def _run(self, paths, name, image):
+        if paths:
+            with span("chown"):
+                if not chown(paths):
+                    self._failed.extend(paths)
+                    return
+        self._done("ownership", name)
+
+        format, level = self._compression.get(name, (None, None))
+        if format is not None and image is not None:
+            with span("compress " + name):
+                if not self._compressor.compress_tree(image, format, level):
+                    self._failed.append(image)
+                    return
+            self._done("compress", name)
+
+    def queue(self, paths, name=None, image=None):
+        if not paths and self._compression.get(name, (None, None))[0] is None:
+            self._done("ownership", name)
+            return
+        thread = threading.Thread(target=self._run, args=(paths, name, image))
+        thread.start()
+        self._threads.append(thread)
+
+    def wait(self):
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._compressor is not None:
+            self._compressor.close()
+        if self._failed:
+            logger.fatal("Unable to finish images: %s" % ", ".join(self._failed))
+
+def root_owned_entries(path):
+    # Top level entries of @path not owned by us
+    uid = os.getuid()
+    result = set()
+    for name in os.listdir(path):
+        if os.lstat(os.path.join(path, name)).st_uid != uid:
+            result.add(name)
+    return result
+
+def get_manifest_filename():
     script_dir = os.path.realpath(os.path.dirname(sys.argv[0]))
-    manifest_filename = os.path.join(script_dir, "maui-build.json")
+    return os.path.join(script_dir, "maui-build.json")
+
+def readconf():
+    manifest_filename = get_manifest_filename()
     if not os.path.exists(manifest_filename):
         logger.fatal("Please provide \"maui-build.json\" manifest!")
 
@@ -54,79 +145,646 @@ def readconf():
 
 def resolve(sources_dir):
     # Update git sources
-    if os.path.isdir(sources_dir):
-        run_sync(["git", "pull"], cwd=sources_dir)
+    if not os.path.isdir(sources_dir):
+        logger.fatal("Sources directory \"%s\" doesn't exist" % sources_dir)
+    run_sync(["git", "pull"], cwd=sources_dir)
 
-def copy_sources(sources_dir, build_dir):
-    # Copy sources to a location where we can build in peace
+def snapshot_dir(build_dir):
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-    new_sources_dir = os.path.join(build_dir, "builds", timestamp)
-    shutil.copytree(sources_dir, new_sources_dir)
+    return os.path.join(build_dir, "builds", timestamp)
+
+def copy_sources(sources_dir, build_dir, strategy="auto"):
+    # Copy sources to a location where we can build in peace
+    new_sources_dir = snapshot_dir(build_dir)
+    create_snapshot(sources_dir, new_sources_dir, strategy)
     return new_sources_dir
 
-def build(targets, sdk_cmd, sources_dir, build_dir):
-    # Save build information
-    info = []
+def export_sources(mirrors, sources, commits, build_dir):
+    # Assemble the resolved commits of all sources in a new snapshot
+    new_sources_dir = snapshot_dir(build_dir)
+    mirrors.export(sources, commits, new_sources_dir)
+    return new_sources_dir
 
-    # Build targets
-    for target in targets:
-        # Skip disabled targets
-        if target.get("disabled", False):
-            continue
+def sources_commit(sources_dir):
+    return git_output(["rev-parse", "HEAD"], sources_dir) or ""
+
+def remote_commit(sources_dir):
+    # Ask the remote which commit the tracked branch points to, this is
+    # much cheaper than fetching
+    upstream = git_output(["rev-parse", "--abbrev-ref", "--symbolic-full-name", "@{u}"], sources_dir)
+    if not upstream or "/" not in upstream:
+        return sources_commit(sources_dir)
+    remote, branch = upstream.split("/", 1)
+    output = git_output(["ls-remote", remote, "refs/heads/" + branch], sources_dir)
+    if not output:
+        return None
+    return output.split()[0]
+
+def sdk_identity(sdk_cmd):
+    # Hashing the whole SDK would take ages, the chroot script and the
+    # time the SDK directory was last touched are good enough
+    sdk_cmd = os.path.realpath(sdk_cmd)
+    mtime = os.stat(os.path.dirname(sdk_cmd)).st_mtime if os.path.exists(sdk_cmd) else 0
+    return "%s:%s:%d" % (sdk_cmd, fingerprint([sdk_cmd]), mtime)
+
+def check_inputs(target, sources_dir, state, inputs):
+    # Return the fingerprint of target inputs and the previous build
+    # information when they didn't change
+    config_filename = os.path.join(sources_dir, target["config"])
+    ks_filename = os.path.join(sources_dir, target["name"] + ".ks")
+    digest = fingerprint([config_filename, ks_filename], inputs + [target["cache"]])
+    previous = state.get(target["name"])
+    if previous and previous.get("fingerprint") == digest and os.path.isdir(previous.get("path", "")):
+        return digest, previous
+    return digest, None
+
+def resumed_image(target, journal, fixer):
+    # Image built by the run being resumed, ownership is rectified
+    # again if that didn't happen
+    info = journal.get("image", target["name"]) if journal is not None else None
+    if not info or not os.path.exists(info["path"]):
+        return None
+    logger.info("Image of \"%s\" was already built, resuming" % target["name"])
+    if not info.get("reused"):
+        if journal.get("ownership", target["name"]) is None:
+            fixer.queue([info["path"]], target["name"], info["path"])
+        elif journal.get("compress", target["name"]) is None:
+            fixer.queue([], target["name"], info["path"])
+    return dict(info, resumed=True)
+
+def reserve_space(target, state, admission):
+    # Wait for enough free space for what the target is expected to
+    # write, rather than failing halfway through
+    if admission is None:
+        return 0
+    previous = state.get(target["name"]) or {}
+    size = admission.estimate(previous.get("size"))
+    if not admission.acquire(target["name"], size):
+        logger.fatal("Not enough space to build \"%s\"" % target["name"])
+    return size
+
+def build_target(target, sdk_cmd, sources_dir, build_dir, state, inputs, fixer, names,
+                 log_dir, compress_logs, journal=None, admission=None, staging=None, sessions=None,
+                 resources=None):
+    info = resumed_image(target, journal, fixer)
+    if info:
+        return info
 
-        # Create kickstart files
-        config_filename = os.path.join(sources_dir, target["config"])
-        cmd = [sdk_cmd, "cd", "/parentroot" + sources_dir, ";",
-               "maui-kickstarter", "-e", ".", "-c", target["config"]]
-        run_sync(cmd)
+    # Skip the build when inputs didn't change since the last published image
+    digest, previous = check_inputs(target, sources_dir, state, inputs)
+    if previous:
+        logger.info("Inputs of \"%s\" didn't change, reusing %s" % (target["name"], previous["path"]))
+        return {"name": target["name"], "path": previous["path"],
+                "fingerprint": digest, "reused": True}
 
-        # Create packages empty cache
-        cache_dir = os.path.join(build_dir, "cache", target["cache"])
-        if not os.path.isdir(cache_dir):
-            ensure_parent_dir(cache_dir)
+    # Create packages empty cache
+    cache_dir = os.path.join(build_dir, "cache", target["cache"])
+    if not os.path.isdir(cache_dir):
+        ensure_parent_dir(cache_dir)
 
-        # Run build
-        cmd = [sdk_cmd, "cd", "/parentroot" + sources_dir, ";",
-               "sudo", "mic", "create", "auto", target["name"] + ".ks",
+    # Build in memory when the working set fits
+    staging_size = None
+    staging_dir = None
+    if staging is not None:
+        working_set = target.get("working_set")
+        if working_set is not None:
+            working_set = parse_size(working_set)
+        staging_size = staging.estimate((state.get(target["name"]) or {}).get("size"), working_set)
+        staging_dir = staging.reserve(target["name"], staging_size)
+
+    # Run build
+    before = root_owned_entries(sources_dir)
+    cd_cmd = ["cd", "/parentroot" + (staging_dir or sources_dir), ";"]
+    mic_cmd = ["sudo", "mic", "create", "auto", target["name"] + ".ks",
                "-k", "/parentroot" + cache_dir]
-        run_sync(cmd)
+    if staging_dir:
+        shutil.copy2(os.path.join(sources_dir, target["name"] + ".ks"), staging_dir)
+        mic_cmd += ["-c", "/parentroot" + write_mic_config(staging_dir)]
+    space = reserve_space(target, state, admission)
+    capture = OutputCapture(os.path.join(log_dir, target["name"] + ".log"), compress=compress_logs)
+    start_time = time.time()
+    try:
+        with span("build " + target["name"]):
+            if sessions is not None:
+                # Sessions are shared by targets, the profile only
+                # applies to mic, words are joined into a shell line
+                if resources is not None and not resources.empty():
+                    mic_cmd = [shell_quote(arg) for arg in resources.wrap(mic_cmd, "/parentroot")]
+                sessions.run_sync(cd_cmd + mic_cmd, capture=capture)
+            else:
+                run_sync([sdk_cmd] + cd_cmd + mic_cmd, capture=capture, resources=resources)
+            # Only the final image goes to disk
+            if staging_dir:
+                run_sync(["sudo", "mv", os.path.join(staging_dir, target["name"]), sources_dir])
+    finally:
+        capture.close()
+        if staging_dir:
+            staging.release(staging_dir, staging_size)
+        if admission is not None:
+            admission.release(space)
 
-        # Rectify owner after using sudo
-        chown(sources_dir)
+    # Rectify owner after using sudo, only for what this run created:
+    # the image directory and anything else mic left behind, except
+    # for output of other targets being built at the same time
+    path = os.path.join(sources_dir, target["name"])
+    size = tree_size(path)
+    state.update(target["name"], size=size)
+    info = {"name": target["name"], "path": path, "fingerprint": digest,
+            "duration": time.time() - start_time, "size": size}
+    if journal is not None:
+        journal.done("image", target["name"], **info)
+    owned = root_owned_entries(sources_dir)
+    created = owned - before - (names - set([target["name"]]))
+    # A failed attempt may have left the image directory root owned
+    if target["name"] in owned:
+        created.add(target["name"])
+    fixer.queue([os.path.join(sources_dir, name) for name in sorted(created)], target["name"], path)
+
+    # Return build information
+    return info
 
-        # Append build information
-        path = os.path.join(sources_dir, target["name"])
-        info.append({"name": target["name"], "path": path})
+def build_target_remote(target, pool, sources_dir, state, inputs, fixer, journal=None,
+                        admission=None):
+    # Same as build_target() but mic runs on a worker and the image
+    # is transferred back here
+    info = resumed_image(target, journal, fixer)
+    if info:
+        return info
+
+    digest, previous = check_inputs(target, sources_dir, state, inputs)
+    if previous:
+        logger.info("Inputs of \"%s\" didn't change, reusing %s" % (target["name"], previous["path"]))
+        return {"name": target["name"], "path": previous["path"],
+                "fingerprint": digest, "reused": True}
+
+    path = os.path.join(sources_dir, target["name"])
+    space = reserve_space(target, state, admission)
+    start_time = time.time()
+    try:
+        with span("build " + target["name"]):
+            pool.build(target, os.path.join(sources_dir, target["name"] + ".ks"), path)
+    except (WorkerError, BuildError) as e:
+        logger.fatal(str(e))
+    finally:
+        if admission is not None:
+            admission.release(space)
+    size = tree_size(path)
+    state.update(target["name"], size=size)
 
+    # Images transferred from workers are already ours
+    info = {"name": target["name"], "path": path, "fingerprint": digest,
+            "duration": time.time() - start_time, "size": size}
+    if journal is not None:
+        journal.done("image", target["name"], **info)
+    fixer.queue([], target["name"], path)
     return info
 
-def main():
-    # Read configuration and take a dictionary
-    data = readconf()
-    if not data:
-        logger.fatal("No valid configuration found")
+def build(targets, sdk_cmd, sources_dir, build_dir, state, commit, jobs=1, cache_limit=None,
+          prewarm_jobs=0, compress_logs=False, pool=None, journal=None, compression="none",
+          compress_jobs=0, admission=None, history=None, staging=None, sdk_session=False,
+          resources=None):
+    # Inputs shared by all targets
+    started = time.time()
+    sdk_id = sdk_identity(sdk_cmd)
+    inputs = [commit, sdk_id]
 
-    # Paths
-    sources_dir = os.path.expanduser(data["paths"]["sources"])
-    build_dir = os.path.expanduser(data["paths"]["buildroot"])
-    publish_dir = os.path.expanduser(data["paths"]["publish"])
+    # Skip disabled targets
+    targets = [target for target in targets if not target.get("disabled", False)]
 
-    # Update sources and make a working copy
-    resolve(sources_dir)
-    new_sources_dir = copy_sources(sources_dir, build_dir)
+    # Start with targets expected to take longer so that the run ends
+    # sooner, those never built before go first
+    if history is not None:
+        predicted = dict([(target["name"], history.predict(target["name"])) for target in targets])
+        targets.sort(key=lambda target: -predicted[target["name"]]
+                     if predicted[target["name"]] is not None else float("-inf"))
+        logger.info("Build order: %s" % ", ".join([target["name"] for target in targets]))
 
-    # Build targets
-    builds = build(data["targets"], data["sdk"]["chroot"], new_sources_dir, build_dir)
+    # Images are compressed according to the target or the default
+    # compression, which is part of the target inputs
+    target_compression = {}
+    target_inputs = {}
+    for target in targets:
+        try:
+            format, level = parse_compression(target.get("compression", compression))
+        except ValueError as e:
+            logger.fatal(str(e))
+        target_compression[target["name"]] = (format, level)
+        target_inputs[target["name"]] = inputs
+        if format is not None:
+            target_inputs[target["name"]] = inputs + ["compression:%s:%d" % (format, level)]
+
+    # Resources each target can use, the resources section of the
+    # manifest has defaults and targets may override them
+    options = resources or {}
+    cgroup_root = options.get("cgroup") if cgroup2_available() else None
+    profiles = dict([(target["name"],
+                      ResourceProfile.from_settings(target["name"],
+                                                    dict(options.get("default", {}),
+                                                         **target.get("resources", {})),
+                                                    cgroup_root))
+                     for target in targets])
+
+    # Output of each target goes to its own log file
+    log_dir = os.path.join(build_dir, "logs", os.path.basename(sources_dir))
+
+    # Enter the SDK chroot once for each target built at the same time
+    sessions = None
+    if sdk_session:
+        sessions = ChrootSessionPool(sdk_cmd, jobs)
+
+    try:
+        # Create kickstart files once for each configuration
+        if journal is None or journal.get("kickstart") is None:
+            capture = OutputCapture(os.path.join(log_dir, "kickstarter.log"), compress=compress_logs)
+            try:
+                with span("kickstart"):
+                    generate_kickstarts([target["config"] for target in targets], sdk_cmd, sources_dir,
+                                        os.path.join(build_dir, "kickstarts"), [sdk_id], capture, sessions)
+            finally:
+                capture.close()
+            if journal is not None:
+                journal.done("kickstart")
+
+        # Keep track of packages caches usage
+        package_cache = PackageCache(os.path.join(build_dir, "cache"), cache_limit)
+
+        # Download packages of targets that will be built ahead of time,
+        # workers have their own packages caches
+        if prewarm_jobs > 0 and pool is None:
+            kickstarts = [(os.path.join(sources_dir, target["name"] + ".ks"), target["cache"])
+                          for target in targets
+                          if not check_inputs(target, sources_dir, state, target_inputs[target["name"]])[1]]
+            prewarmer = Prewarmer(os.path.join(build_dir, "cache"), package_cache, prewarm_jobs)
+            with span("prewarm"):
+                prewarmer.run(kickstarts)
+
+        package_cache.begin()
+
+        # Targets sharing a packages cache are never built at the same time
+        # here, while workers build one target at a time each
+        # The compression threads are only started when needed
+        compressor = None
+        if any([format is not None for format, level in target_compression.values()]):
+            compressor = Compressor(compress_jobs)
+        fixer = ImageFinisher(journal, compressor, target_compression)
+        names = set([target["name"] for target in targets])
+        if pool is None:
+            scheduler = Scheduler(jobs)
+            for target in targets:
+                scheduler.add(target["name"], build_target,
+                              (target, sdk_cmd, sources_dir, build_dir, state, target_inputs[target["name"]],
+                               fixer, names,
+                               log_dir, compress_logs, journal, admission, staging, sessions,
+                               profiles[target["name"]]),
+                              locks=["cache:" + target["cache"]])
+        else:
+            scheduler = Scheduler(len(pool.workers))
+            for target in targets:
+                scheduler.add(target["name"], build_target_remote,
+                              (target, pool, sources_dir, state, target_inputs[target["name"]],
+                               fixer, journal, admission))
 
-    # Publish targets
+        finished = scheduler.run()
+        logger.info("Resource usage:\n%s" %
+                    usage_report([profiles[job.name] for job in finished if job.result is not None
+                                  and not job.result.get("reused")]))
+    finally:
+        if sessions is not None:
+            sessions.close()
+        for profile in profiles.values():
+            profile.close()
+
+    # Save build information
+    info = [job.result for job in finished if job.result is not None]
+    fixer.wait()
+    with span("cache"):
+        cache_stats = package_cache.finish()
+    failed = scheduler.failed()
+
+    # Remember how long targets took, images built by a previous run
+    # being resumed were already recorded
+    if history is not None:
+        caches = dict([(target["name"], target["cache"]) for target in targets])
+        entries = []
+        for job in finished:
+            result = job.result or {}
+            entries.append({"name": job.name, "duration": result.get("duration"),
+                            "size": result.get("size"), "cache": caches[job.name],
+                            "reused": result.get("reused", False) or result.get("resumed", False),
+                            "success": job.error is None})
+        history.record(started, commit, entries, cache_stats or {}, not failed)
+    if failed:
+        logger.fatal("Failed to build: %s" % ", ".join([job.name for job in failed]))
+    return info
+
+def publish(builds, publish_dir, store, state, zsync=False, journal=None, index=None, commit=None):
     for b in builds:
         timestamp = datetime.datetime.now().strftime("%Y%m%d")
         dest_dir = os.path.join(publish_dir, timestamp, b["name"])
         ensure_parent_dir(dest_dir)
-        shutil.move(b["path"], dest_dir)
+        if b.get("reused") and os.path.realpath(b["path"]) == os.path.realpath(dest_dir):
+            continue
+        if journal is not None and journal.get("publish", b["name"]) == {"path": dest_dir} \
+                and os.path.isdir(dest_dir):
+            continue
+        with span("publish " + b["name"]):
+            # Images built again on the same day replace previous ones
+            if os.path.isdir(dest_dir):
+                shutil.rmtree(dest_dir)
+            if b.get("reused"):
+                success = tree_linkcopy(b["path"], dest_dir)
+            else:
+                success = store.publish_tree(b["path"], dest_dir, zsync)
+            if not success:
+                logger.fatal("Unable to publish \"%s\"" % b["name"])
+
+        # Reused images were built from an older commit
+        image_commit = commit
+        if b.get("reused"):
+            image_commit = (state.get(b["name"]) or {}).get("commit")
+        if index is not None:
+            index.add(timestamp, b["name"], dest_dir, b.get("duration"), image_commit)
+        state.update(b["name"], fingerprint=b["fingerprint"], path=dest_dir, commit=image_commit)
+        state.save()
+        if journal is not None:
+            journal.done("publish", b["name"], path=dest_dir)
+
+_local_workers = []
+_local_secret = binascii.hexlify(os.urandom(16)).decode("ascii")
+
+def worker_secret(data, required=True):
+    # Workers only accept requests carrying the secret of the manifest
+    secret = data.get("workers", {}).get("secret")
+    if not secret and required:
+        logger.fatal("Please set \"secret\" in the \"workers\" section")
+    return secret
+
+def worker_pool(data):
+    # Build hosts from the manifest, plus workers in other processes
+    # on this host; None when targets are built here
+    options = data.get("workers", {})
+    hosts = list(options.get("hosts", []))
+    local = options.get("local", 0)
+    if not hosts and local <= 0:
+        return None
+    # Local workers alone don't need a secret from the manifest
+    secret = worker_secret(data, required=bool(hosts))
+    if secret is None:
+        secret = _local_secret
+    if local > 0:
+        if not _local_workers:
+            build_dir = os.path.expanduser(data["paths"]["buildroot"])
+            processes, addresses = start_local_workers(local, data["sdk"]["chroot"],
+                                                       os.path.join(build_dir, "workers"), secret)
+            _local_workers.extend(addresses)
+        hosts.extend(_local_workers)
+    return WorkerPool(hosts, secret, options.get("retry_interval", 60))
+
+def history_filename(data):
+    build_dir = os.path.expanduser(data["paths"]["buildroot"])
+    return os.path.join(build_dir, "history.sqlite")
+
+def object_store(data):
+    publish_dir = os.path.expanduser(data["paths"]["publish"])
+    store_dir = data["paths"].get("store", os.path.join(publish_dir, ".objects"))
+    return ObjectStore(os.path.expanduser(store_dir))
+
+def prune_published(data, store):
+    # Snapshots are kept forever unless a retention policy is given
+    options = data.get("retention", {})
+    if "daily" not in options and "weekly" not in options:
+        return
+    publish_dir = os.path.expanduser(data["paths"]["publish"])
+    with span("prune"):
+        removed = prune_snapshots(publish_dir, options.get("daily", 7), options.get("weekly", 0), store)
+        if removed:
+            SnapshotIndex(publish_dir).remove(removed)
+
+def collect_garbage(data, keep=()):
+    # Remove build trees of failed runs, except those in @keep, cache
+    # entries not used for a while and old snapshots
+    build_dir = os.path.expanduser(data["paths"]["buildroot"])
+    options = data.get("retention", {})
+    with span("gc"):
+        remove_orphans(build_dir, keep)
+        remove_stale(os.path.join(build_dir, "kickstarts"), options.get("cache_max_age", 30))
+    prune_published(data, object_store(data))
+
+def staging_area(data):
+    # Images are assembled in memory when the staging section is given
+    options = data.get("staging")
+    if options is None:
+        return None
+    path = os.path.expanduser(options["path"])
+    if filesystem_type(path) not in ("tmpfs", "ramfs"):
+        logger.warning("Staging path %s is not on a tmpfs, building on disk" % path)
+        return None
+    return StagingArea(path, parse_size(options.get("memory", "4G")), options.get("factor", 3.0))
+
+def space_admission(data, new_sources_dir):
+    # Targets wait for enough free space when the disk section is given
+    options = data.get("disk")
+    if options is None:
+        return None
+    return SpaceAdmission(new_sources_dir, parse_size(options.get("min_free", 0)),
+                          parse_size(options.get("target_size", "4G")), options.get("headroom", 2.0),
+                          lambda: collect_garbage(data, [new_sources_dir]))
+
+def build_and_publish(data, new_sources_dir, build_dir, publish_dir, commit, state=None,
+                      journal=None):
+    # Build targets
+    if state is None:
+        state = BuildState(os.path.join(build_dir, "state.json"))
+    jobs = data.get("build", {}).get("jobs", 1)
+    cache_limit = data.get("cache", {}).get("size_limit")
+    if cache_limit is not None:
+        cache_limit = parse_size(cache_limit)
+    prewarm_jobs = data.get("cache", {}).get("prewarm_jobs", 0)
+    compress_logs = data.get("build", {}).get("compress_logs", False)
+    compression = data.get("publish", {}).get("compression", "none")
+    compress_jobs = data.get("publish", {}).get("compress_jobs", 0)
+    pool = worker_pool(data)
+    admission = space_admission(data, new_sources_dir)
+    history = BuildHistory(history_filename(data))
+    try:
+        builds = build(data["targets"], data["sdk"]["chroot"], new_sources_dir, build_dir,
+                       state, commit, jobs, cache_limit, prewarm_jobs, compress_logs, pool, journal,
+                       compression, compress_jobs, admission, history, staging_area(data),
+                       data["sdk"].get("session", False), data.get("resources"))
+    finally:
+        history.close()
+
+    # Publish targets, identical files are stored only once
+    store = object_store(data)
+    zsync = data.get("publish", {}).get("zsync", False)
+    if zsync and not md4_available():
+        logger.warning("MD4 is not available from OpenSSL, zsync files won't be created")
+        zsync = False
+    publish(builds, publish_dir, store, state, zsync, journal, SnapshotIndex(publish_dir), commit)
+    prune_published(data, store)
 
     # Remove sources directory (it's a copy, don't worry)
-    shutil.rmtree(new_sources_dir)
+    with span("cleanup"):
+        shutil.rmtree(new_sources_dir)
+    if journal is not None:
+        journal.finish()
+
+def buildroot_lock(build_dir):
+    # Runs sharing a buildroot would remove each other's build trees
+    lock = lock_file(os.path.join(build_dir, "build.lock"))
+    if lock is None:
+        logger.fatal("Another build is already running in %s" % build_dir)
+    return lock
+
+def run_build(data, state=None, resume=False, locked=False):
+    # The daemon holds the lock for as long as it runs
+    if locked:
+        return _run_build(data, state, resume)
+    with buildroot_lock(os.path.expanduser(data["paths"]["buildroot"])):
+        _run_build(data, state, resume)
+
+def _run_build(data, state, resume):
+    # Paths
+    build_dir = os.path.expanduser(data["paths"]["buildroot"])
+    publish_dir = os.path.expanduser(data["paths"]["publish"])
+
+    # Progress is recorded so that a failed run can be resumed
+    tracer.reset()
+    journal = Journal(os.path.join(build_dir, "journal.json"))
+    pending = journal.pending()
+    if resume and pending:
+        new_sources_dir, commit = pending
+        logger.info("Resuming the build of %s" % new_sources_dir)
+        collect_garbage(data, [new_sources_dir])
+    else:
+        if resume:
+            logger.warning("No build to resume, starting a new one")
+        elif pending:
+            logger.warning("Discarding the unfinished build of %s, use --resume to continue it instead" %
+                           pending[0])
+        journal.start()
+        collect_garbage(data)
+
+        # Update sources and make a working copy
+        if "sources" in data:
+            sources = parse_sources(data["sources"])
+            mirrors = SourceMirrors(os.path.join(build_dir, "mirrors"))
+            with span("resolve"):
+                commits = mirrors.resolve(sources)
+                commit = combined_commit(commits)
+            with span("copy_sources"):
+                new_sources_dir = export_sources(mirrors, sources, commits, build_dir)
+        else:
+            sources_dir = os.path.expanduser(data["paths"]["sources"])
+            with span("resolve"):
+                resolve(sources_dir)
+                commit = sources_commit(sources_dir)
+                commits = {"sources": commit}
+            snapshot = data.get("build", {}).get("snapshot", "auto")
+            with span("copy_sources"):
+                new_sources_dir = copy_sources(sources_dir, build_dir, snapshot)
+        journal.done("snapshot", path=new_sources_dir, commit=commit, sources=commits)
+
+        # Exact inputs of the run, kept along with its logs
+        sources_filename = os.path.join(build_dir, "logs", os.path.basename(new_sources_dir), "sources.json")
+        ensure_parent_dir(sources_filename)
+        with open(sources_filename, "w") as f:
+            f.write(json.dumps(commits, indent=4, sort_keys=True))
+
+    # Where time was spent is reported even when the build fails
+    trace_filename = os.path.join(build_dir, "logs", os.path.basename(new_sources_dir), "trace.json")
+    try:
+        build_and_publish(data, new_sources_dir, build_dir, publish_dir, commit, state, journal)
+    finally:
+        ensure_parent_dir(trace_filename)
+        tracer.report(trace_filename)
+
+def daemon_socket(data):
+    build_dir = os.path.expanduser(data["paths"]["buildroot"])
+    return os.path.join(build_dir, data.get("daemon", {}).get("socket", "daemon.sock"))
+
+def run_daemon(data):
+    # Manifest and build state stay in memory, the manifest is read
+    # again only when it changes
+    manifest_filename = get_manifest_filename()
+    current = {"data": data, "mtime": os.stat(manifest_filename).st_mtime}
+    build_dir = os.path.expanduser(data["paths"]["buildroot"])
+    # Held until the daemon exits, so builds don't take it again
+    lock = buildroot_lock(build_dir)
+    state = BuildState(os.path.join(build_dir, "state.json"))
+
+    def check():
+        if "sources" in current["data"]:
+            commits = remote_commits(parse_sources(current["data"]["sources"]))
+            return [sorted(commits.items()), os.stat(manifest_filename).st_mtime]
+        sources_dir = os.path.expanduser(current["data"]["paths"]["sources"])
+        return [remote_commit(sources_dir), os.stat(manifest_filename).st_mtime]
+
+    def build():
+        mtime = os.stat(manifest_filename).st_mtime
+        if mtime != current["mtime"]:
+            new_data = readconf()
+            if not new_data:
+                logger.fatal("No valid configuration found")
+            current["data"] = new_data
+            current["mtime"] = mtime
+        run_build(current["data"], state, locked=True)
+
+    options = data.get("daemon", {})
+    daemon = BuildDaemon(check, build, options.get("interval", 60),
+                         options.get("debounce", 300), daemon_socket(data))
+    daemon.run()
+
+def main():
+    parser = argparse.ArgumentParser(description="Build daily images for Maui")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and build when sources change")
+    parser.add_argument("--status", action="store_true",
+                        help="show the status of a running daemon")
+    parser.add_argument("--trigger", action="store_true",
+                        help="ask a running daemon to build now")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue the last build where it stopped")
+    parser.add_argument("--report", action="store_true",
+                        help="show how long targets took in past runs")
+    parser.add_argument("--gc", action="store_true",
+                        help="only remove old snapshots and what failed builds left behind")
+    parser.add_argument("--worker", metavar="[HOST:]PORT",
+                        help="build targets sent by another host, listening on localhost by default")
+    args = parser.parse_args()
+
+    # Read configuration and take a dictionary
+    data = readconf()
+    if not data:
+        logger.fatal("No valid configuration found")
+
+    # Machine readable logs
+    if data.get("build", {}).get("log_format", "text") == "json":
+        configure_logger(json_lines=True)
+
+    if args.status or args.trigger:
+        reply = send_command(daemon_socket(data), "status" if args.status else "trigger")
+        print(json.dumps(reply, indent=4, sort_keys=True))
+    elif args.report:
+        history = BuildHistory(history_filename(data))
+        table, regressions = history.report(data.get("history", {}).get("regression_threshold", 30.0))
+        history.close()
+        print(table)
+        if regressions:
+            sys.exit(1)
+    elif args.gc:
+        build_dir = os.path.expanduser(data["paths"]["buildroot"])
+        with buildroot_lock(build_dir):
+            pending = Journal(os.path.join(build_dir, "journal.json")).pending()
+            collect_garbage(data, [pending[0]] if pending else [])
+    elif args.worker:
+        build_dir = os.path.expanduser(data["paths"]["buildroot"])
+        serve(parse_address(args.worker), data["sdk"]["chroot"], os.path.join(build_dir, "worker"),
+              worker_secret(data))
+    elif args.daemon:
+        run_daemon(data)
+    else:
+        run_build(data, resume=args.resume)
 
 if __name__ == "__main__":
     main()
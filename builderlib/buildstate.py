@@ -0,0 +1,76 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import hashlib
+import threading
+
+from .fileutil import atomic_write_json
+
+def hash_file(hasher, path):
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            hasher.update(data)
+
+def fingerprint(files, extra=()):
+    """Return a digest of the contents of @files and the @extra strings.
+
+    Missing files are part of the fingerprint too, so a file going away
+    changes it.
+    """
+    hasher = hashlib.sha256()
+    for path in files:
+        hasher.update(("file:%s\n" % os.path.basename(path)).encode("utf-8"))
+        if os.path.exists(path):
+            hash_file(hasher, path)
+        else:
+            hasher.update(b"missing\n")
+    for value in extra:
+        hasher.update(("extra:%s\n" % value).encode("utf-8"))
+    return hasher.hexdigest()
+
+class BuildState(object):
+    """Persistent per-target build state, stored as JSON under the buildroot."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self._data = json.loads(f.read())
+            except ValueError:
+                self._data = {}
+
+    def get(self, name):
+        with self._lock:
+            return self._data.get(name)
+
+    def update(self, name, **kwargs):
+        with self._lock:
+            self._data.setdefault(name, {}).update(kwargs)
+
+    def save(self):
+        with self._lock:
+            atomic_write_json(self.filename, self._data, indent=4, sort_keys=True)
@@ -0,0 +1,163 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import hashlib
+
+from .logger import Logger
+from .subprocess_helpers import run_sync_with_input_get_output
+from .buildstate import hash_file
+
+logger = Logger()
+
+class PackageCache(object):
+    """Keep the packages caches used by mic within a size budget.
+
+    Cache directories are written by mic running as root, so changes
+    are made with sudo.  Hits are detected
+    from access times and are approximate on noatime mounts.
+    """
+
+    def __init__(self, path, size_limit=None):
+        self.path = path
+        self.size_limit = size_limit
+        self._logger = logger
+        self._before = {}
+
+    def _scan(self):
+        # Map each package to its stat result
+        result = {}
+        if not os.path.isdir(self.path):
+            return result
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith(".rpm"):
+                    path = os.path.join(dirpath, filename)
+                    result[path] = os.stat(path)
+        return result
+
+    def _run(self, args, input):
+        if os.getuid() != 0:
+            args = ["sudo"] + args
+        run_sync_with_input_get_output(args, input.encode("utf-8"), none_on_error=True)
+
+    def _remove(self, paths):
+        if paths:
+            self._run(["xargs", "-0", "rm", "-f", "--"], "\0".join(paths))
+
+    def _link(self, pairs):
+        if pairs:
+            script = 'while IFS= read -r src && IFS= read -r dest; do ln -f -- "$src" "$dest"; done'
+            self._run(["sh", "-c", script], "".join(["%s\n%s\n" % pair for pair in pairs]))
+
+    def import_files(self, pairs):
+        """Move files into the caches, @pairs are (source, destination) tuples."""
+        if pairs:
+            script = ('while IFS= read -r src && IFS= read -r dest; do '
+                      'mkdir -p -- "$(dirname -- "$dest")" && mv -f -- "$src" "$dest"; done')
+            self._run(["sh", "-c", script], "".join(["%s\n%s\n" % pair for pair in pairs]))
+
+    def begin(self):
+        """Remember the cache contents before mic runs."""
+        self._before = self._scan()
+
+    def deduplicate(self, files):
+        """Hard link identical packages found in more than one cache."""
+        candidates = {}
+        for path, st in files.items():
+            candidates.setdefault((os.path.basename(path), st.st_size), []).append(path)
+
+        pairs = []
+        saved = 0
+        for paths in candidates.values():
+            # Packages linked by a previous run are hashed only once
+            inodes = {}
+            for path in sorted(paths):
+                inodes.setdefault((files[path].st_dev, files[path].st_ino), []).append(path)
+            if len(inodes) < 2:
+                continue
+            by_digest = {}
+            for linked in sorted(inodes.values()):
+                hasher = hashlib.sha256()
+                hash_file(hasher, linked[0])
+                by_digest.setdefault(hasher.hexdigest(), []).append(linked)
+            for same in by_digest.values():
+                first = same[0][0]
+                for linked in same[1:]:
+                    for path in linked:
+                        pairs.append((first, path))
+                    saved += files[first].st_size
+        self._link(pairs)
+        return saved
+
+    def evict(self, files):
+        """Remove least recently used packages until the cache fits the budget."""
+        # Hard links take space only once
+        inodes = {}
+        for path, st in files.items():
+            inodes.setdefault((st.st_dev, st.st_ino), []).append(path)
+        total = sum([files[paths[0]].st_size for paths in inodes.values()])
+        if self.size_limit is None or total <= self.size_limit:
+            return 0, 0
+
+        lru = sorted(inodes.values(),
+                     key=lambda paths: max([max(files[p].st_atime, files[p].st_mtime) for p in paths]))
+        removed = []
+        freed = 0
+        for paths in lru:
+            if total - freed <= self.size_limit:
+                break
+            removed.extend(paths)
+            freed += files[paths[0]].st_size
+        self._remove(removed)
+        return len(removed), freed
+
+    def finish(self):
+        """Deduplicate, enforce the budget and report statistics for this run.
+
+        Returns a dictionary with statistics for each cache directory.
+        """
+        after = self._scan()
+        stats = {}
+        for path, st in after.items():
+            name = os.path.relpath(path, self.path).split(os.sep)[0]
+            entry = stats.setdefault(name, {"hits": 0, "misses": 0, "size": 0})
+            entry["size"] += st.st_size
+            old = self._before.get(path)
+            if old is None:
+                entry["misses"] += 1
+            elif st.st_atime > old.st_atime:
+                entry["hits"] += 1
+
+        for name in sorted(stats):
+            entry = stats[name]
+            used = entry["hits"] + entry["misses"]
+            ratio = 100.0 * entry["hits"] / used if used else 0.0
+            self._logger.info("Cache %s: %d hits, %d misses (%.1f%% hit rate), %.1f MiB" %
+                              (name, entry["hits"], entry["misses"], ratio,
+                               entry["size"] / 1048576.0))
+
+        saved = self.deduplicate(after)
+        if saved:
+            self._logger.info("Saved %.1f MiB linking identical packages" % (saved / 1048576.0))
+            after = self._scan()
+        count, freed = self.evict(after)
+        if count:
+            self._logger.info("Evicted %d packages, %.1f MiB" % (count, freed / 1048576.0))
+        return stats
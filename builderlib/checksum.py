@@ -0,0 +1,167 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import math
+import struct
+import hashlib
+import time
+
+ZSYNC_VERSION = "0.6.2"
+
+# Blocks are split in rows of ROW bytes to compute the rolling checksum
+ROW = 64
+
+def _openssl_md4():
+    # OpenSSL 3 moved MD4 to the legacy provider, which hashlib doesn't
+    # load, it's loaded here in a library context of our own
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+    name = ctypes.util.find_library("crypto")
+    if name is None:
+        return None
+    try:
+        lib = ctypes.CDLL(name)
+        lib.OSSL_LIB_CTX_new.restype = ctypes.c_void_p
+        lib.OSSL_PROVIDER_load.restype = ctypes.c_void_p
+        lib.OSSL_PROVIDER_load.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        lib.EVP_MD_fetch.restype = ctypes.c_void_p
+        lib.EVP_MD_fetch.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        lib.EVP_Digest.argtypes = [ctypes.c_char_p, ctypes.c_size_t, ctypes.c_char_p,
+                                   ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    ctx = lib.OSSL_LIB_CTX_new()
+    if not ctx or not lib.OSSL_PROVIDER_load(ctx, b"legacy"):
+        return None
+    algorithm = lib.EVP_MD_fetch(ctx, b"MD4", None)
+    if not algorithm:
+        return None
+
+    def md4(data):
+        data = bytes(data)
+        digest = ctypes.create_string_buffer(16)
+        if not lib.EVP_Digest(data, len(data), digest, None, algorithm, None):
+            raise ValueError("MD4 digest failed")
+        return digest.raw
+    return md4
+
+def _hashlib_md4(data):
+    return hashlib.new("md4", data).digest()
+
+try:
+    hashlib.new("md4")
+    md4 = _hashlib_md4
+except ValueError:
+    md4 = _openssl_md4()
+
+def md4_available():
+    """Whether zsync block checksums can be computed, hashing every
+    block in Python would take hours for an image."""
+    return md4 is not None
+
+class ZsyncBlocks(object):
+    """Block checksums of a file, in the format used by zsync."""
+
+    def __init__(self, length):
+        self.length = length
+        self.blocksize = 2048 if length < 100 * 1024 * 1024 else 4096
+
+        # Same hash lengths zsyncmake would pick
+        self.seq_matches = 2 if length > self.blocksize else 1
+        log_length = math.log(max(length, 1))
+        rsum_bytes = math.ceil(((log_length + math.log(self.blocksize)) / math.log(2) - 8.6) /
+                               self.seq_matches / 8)
+        self.rsum_bytes = int(min(max(rsum_bytes, 2), 4))
+        blocks = 1 + length // self.blocksize
+        checksum_bytes = math.ceil((20 + (log_length + math.log(blocks)) / math.log(2)) /
+                                   self.seq_matches / 8)
+        checksum_bytes = max(checksum_bytes, int((7.9 + (20 + math.log(blocks) / math.log(2))) / 8))
+        self.checksum_bytes = int(min(checksum_bytes, 16))
+
+        self._pending = b""
+        self._sums = []
+
+    def _add_block(self, block):
+        # Last block is padded with zeroes
+        if len(block) < self.blocksize:
+            block = block + b"\x00" * (self.blocksize - len(block))
+        # b is the sum of (blocksize - i) * block[i], computed with
+        # i = row * ROW + column from sums over rows and columns, which
+        # run in C
+        block = bytearray(block)
+        rows = [sum(block[offset:offset + ROW]) for offset in range(0, self.blocksize, ROW)]
+        columns = [sum(block[column::ROW]) for column in range(ROW)]
+        a = sum(rows)
+        weighted = (ROW * sum([row * value for row, value in enumerate(rows)]) +
+                    sum([column * value for column, value in enumerate(columns)]))
+        b = (self.blocksize * a - weighted) & 0xffff
+        a &= 0xffff
+        rsum = struct.pack(">HH", a, b)[4 - self.rsum_bytes:]
+        self._sums.append(rsum + md4(block)[:self.checksum_bytes])
+
+    def update(self, data):
+        if self._pending:
+            data = self._pending + data
+        end = len(data) - len(data) % self.blocksize
+        for offset in range(0, end, self.blocksize):
+            self._add_block(data[offset:offset + self.blocksize])
+        self._pending = data[end:]
+
+    def write(self, filename, name, mtime, sha1):
+        if self._pending:
+            self._add_block(self._pending)
+            self._pending = b""
+        with open(filename, "wb") as f:
+            header = ("zsync: %s\n" % ZSYNC_VERSION +
+                      "Filename: %s\n" % name +
+                      "MTime: %s\n" % time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime(mtime)) +
+                      "Blocksize: %d\n" % self.blocksize +
+                      "Length: %d\n" % self.length +
+                      "Hash-Lengths: %d,%d,%d\n" % (self.seq_matches, self.rsum_bytes,
+                                                    self.checksum_bytes) +
+                      "URL: %s\n" % name +
+                      "SHA-1: %s\n\n" % sha1)
+            f.write(header.encode("utf-8"))
+            f.write(b"".join(self._sums))
+
+class StreamDigest(object):
+    """Compute several digests, and optionally zsync block checksums,
+    from data fed in a single pass."""
+
+    def __init__(self, algorithms=("sha256",), zsync_length=None):
+        self.algorithms = list(algorithms)
+        if zsync_length is not None and "sha1" not in self.algorithms:
+            self.algorithms.append("sha1")
+        self._hashers = dict([(name, hashlib.new(name)) for name in self.algorithms])
+        self.zsync = ZsyncBlocks(zsync_length) if zsync_length is not None else None
+
+    def update(self, data):
+        for hasher in self._hashers.values():
+            hasher.update(data)
+        if self.zsync is not None:
+            self.zsync.update(data)
+
+    def hexdigest(self, name="sha256"):
+        return self._hashers[name].hexdigest()
+
+    def write_zsync(self, filename, name, mtime):
+        self.zsync.write(filename, name, mtime, self.hexdigest("sha1"))
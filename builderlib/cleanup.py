@@ -0,0 +1,118 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Remove what previous runs left behind: old snapshots, build trees
+# of runs that failed and cache entries not used in a long time.
+
+import os
+import time
+import shutil
+import datetime
+
+from .logger import Logger
+from .subprocess_helpers import run_sync
+
+logger = Logger()
+
+def _remove_tree(path):
+    # Trees may contain files created with sudo
+    try:
+        shutil.rmtree(path)
+    except OSError:
+        if not run_sync(["sudo", "rm", "-rf", path], fatal_on_error=False):
+            return False
+    return True
+
+def _snapshot_dates(publish_dir):
+    # Snapshots are directories named after the day they were built
+    result = {}
+    if not os.path.isdir(publish_dir):
+        return result
+    for name in os.listdir(publish_dir):
+        try:
+            result[name] = datetime.datetime.strptime(name, "%Y%m%d").date()
+        except ValueError:
+            continue
+    return result
+
+def snapshots_to_keep(dates, daily, weekly, today=None):
+    """Return the names of snapshots kept among @dates, a dictionary
+    of names and dates: the last @daily ones plus the last of each of
+    the last @weekly weeks."""
+    if today is None:
+        today = datetime.date.today()
+    by_date = sorted(dates.items(), key=lambda item: item[1], reverse=True)
+    keep = set([name for name, date in by_date[:daily]])
+    weeks = set()
+    this_week = today - datetime.timedelta(days=today.weekday())
+    for name, date in by_date:
+        week = date - datetime.timedelta(days=date.weekday())
+        if (this_week - week).days // 7 < weekly and week not in weeks:
+            weeks.add(week)
+            keep.add(name)
+    return keep
+
+def prune_snapshots(publish_dir, daily, weekly, store=None, today=None):
+    """Remove published snapshots outside the retention policy and
+    the objects they were the last to use, return their names."""
+    dates = _snapshot_dates(publish_dir)
+    keep = snapshots_to_keep(dates, daily, weekly, today)
+    removed = []
+    for name in sorted(dates):
+        if name not in keep:
+            logger.info("Removing snapshot %s" % name)
+            if _remove_tree(os.path.join(publish_dir, name)):
+                removed.append(name)
+    if store is not None and removed:
+        store.prune()
+    return removed
+
+def remove_orphans(build_dir, keep=()):
+    """Remove build trees of previous runs, except those in @keep."""
+    builds_dir = os.path.join(build_dir, "builds")
+    if not os.path.isdir(builds_dir):
+        return 0
+    keep = set([os.path.realpath(path) for path in keep])
+    removed = 0
+    for name in sorted(os.listdir(builds_dir)):
+        path = os.path.join(builds_dir, name)
+        if os.path.realpath(path) in keep or not os.path.isdir(path):
+            continue
+        logger.info("Removing build tree left behind %s" % path)
+        if _remove_tree(path):
+            removed += 1
+    return removed
+
+def remove_stale(path, max_age):
+    """Remove entries of @path not used for @max_age days."""
+    if not os.path.isdir(path):
+        return 0
+    limit = time.time() - max_age * 24 * 3600
+    removed = 0
+    for name in sorted(os.listdir(path)):
+        entry = os.path.join(path, name)
+        if os.lstat(entry).st_mtime < limit:
+            logger.info("Removing stale cache entry %s" % entry)
+            if os.path.isdir(entry) and not os.path.islink(entry):
+                if not _remove_tree(entry):
+                    continue
+            else:
+                os.unlink(entry)
+            removed += 1
+    return removed
@@ -0,0 +1,191 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Compress images with several threads.
+#
+# Files are split in chunks compressed independently and written one
+# after another: concatenated xz streams and zstd frames are valid
+# files for the usual tools, and each chunk can be decompressed on
+# its own.
+
+import os
+import shutil
+import threading
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .logger import Logger
+from .staging import mem_available
+from .subprocess_helpers import run_sync
+
+logger = Logger()
+
+FORMATS = {"xz": ".xz", "zstd": ".zst"}
+DEFAULT_LEVELS = {"xz": 6, "zstd": 3}
+IMAGE_EXTENSIONS = (".iso", ".raw", ".img")
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Memory used by the xz encoder for each preset, from xz(1)
+XZ_MEMORY = {0: 3, 1: 9, 2: 17, 3: 32, 4: 48, 5: 94, 6: 94, 7: 186, 8: 370, 9: 674}
+
+def encoder_memory(format, level):
+    """Return an estimate of the memory needed to compress a chunk,
+    in bytes."""
+    if format == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressionParameters.from_level(level).estimated_compression_context_size()
+    return XZ_MEMORY.get(level, XZ_MEMORY[9]) * 1024 * 1024
+
+def parse_compression(value):
+    """Return format and level from a "format[:level]" string, the
+    format is None when images are not compressed."""
+    if not value or value == "none":
+        return None, None
+    if ":" in value:
+        format, level = value.split(":", 1)
+        level = int(level)
+    else:
+        format, level = value, None
+    if format not in FORMATS:
+        raise ValueError("Unknown compression format \"%s\"" % format)
+    if level is None:
+        level = DEFAULT_LEVELS[format]
+    return format, level
+
+def _compress_xz(data, level):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+def _compress_zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+class Compressor(object):
+    """Compress files with a pool of @jobs threads shared by all files.
+
+    Chunks being compressed or waiting to be written, and the encoders
+    working on them, take at most @memory bytes, half of the memory
+    available by default: at xz level 9 each encoder needs 674 MiB,
+    so fewer chunks are compressed at the same time.
+    """
+
+    def __init__(self, jobs=0, chunk_size=CHUNK_SIZE, memory=None):
+        self.jobs = jobs if jobs > 0 else multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        if memory is None:
+            memory = (mem_available() or 4 * 1024 * 1024 * 1024) // 2
+        self.memory = memory
+        self._reserved = 0
+        self._cond = threading.Condition()
+        # Several images are compressed at the same time
+        self._pool = ThreadPool(self.jobs)
+
+    def _reserve(self, size, wait):
+        # Fails when memory is short and the caller has chunks to write
+        # first, a chunk is allowed anyway when nothing else is held
+        with self._cond:
+            while self._reserved > 0 and self._reserved + size > self.memory:
+                if not wait:
+                    return False
+                self._cond.wait()
+            self._reserved += size
+            return True
+
+    def _release(self, size):
+        with self._cond:
+            self._reserved -= size
+            self._cond.notify_all()
+
+    def _compress_func(self, format):
+        # Modules compress without holding the interpreter lock
+        if format == "xz" and lzma is not None:
+            return _compress_xz
+        if format == "zstd" and zstandard is not None:
+            return _compress_zstd
+        return None
+
+    def compress_file(self, src, format, level):
+        """Replace @src with its compressed version."""
+        dest = src + FORMATS[format]
+        tmp_dest = dest + ".tmp"
+        func = self._compress_func(format)
+        if func is None:
+            # Fall back to the command line tool, which also splits
+            # input in blocks compressed by several threads
+            with open(tmp_dest, "wb") as output:
+                success = run_sync([format, "-T%d" % self.jobs, "-%d" % level, "-q", "-c", src],
+                                   stdout=output, fatal_on_error=False)
+            if not success:
+                os.unlink(tmp_dest)
+                return False
+        else:
+            # Input and output of a chunk plus the encoder
+            size = 2 * self.chunk_size + encoder_memory(format, level)
+            pending = collections.deque()
+            held = [0]
+            def write_oldest():
+                output.write(pending.popleft().get())
+                held[0] -= 1
+                self._release(size)
+            try:
+                with open(src, "rb") as input, open(tmp_dest, "wb") as output:
+                    while True:
+                        while not self._reserve(size, wait=not pending):
+                            write_oldest()
+                        held[0] += 1
+                        data = input.read(self.chunk_size)
+                        if not data:
+                            break
+                        pending.append(self._pool.apply_async(func, (data, level)))
+                        if len(pending) >= 2 * self.jobs:
+                            write_oldest()
+                    while pending:
+                        write_oldest()
+            finally:
+                self._release(size * held[0])
+        shutil.copystat(src, tmp_dest)
+        os.rename(tmp_dest, dest)
+        os.unlink(src)
+        return True
+
+    def compress_tree(self, path, format, level):
+        """Compress images found in @path."""
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                filename = os.path.join(dirpath, filename)
+                if filename.endswith(IMAGE_EXTENSIONS) and not os.path.islink(filename):
+                    logger.info("Compressing %s with %s level %d" % (filename, format, level))
+                    if not self.compress_file(filename, format, level):
+                        logger.error("Unable to compress %s" % filename)
+                        return False
+        return True
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
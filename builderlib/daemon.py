@@ -0,0 +1,198 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import time
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .logger import Logger
+
+logger = Logger()
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        command = self.rfile.readline().decode("utf-8").strip()
+        daemon = self.server.daemon
+        if command == "status":
+            reply = daemon.status()
+        elif command == "trigger":
+            daemon.trigger()
+            reply = {"result": "ok"}
+        else:
+            reply = {"result": "error", "message": "Unknown command \"%s\"" % command}
+        self.wfile.write((json.dumps(reply, sort_keys=True) + "\n").encode("utf-8"))
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class BuildDaemon(object):
+    """Poll for changes and build when inputs changed.
+
+    @check returns a token describing the inputs, such as the remote
+    commit; @build is called once the token has been stable for
+    @debounce seconds.  A failed build is not retried until the token
+    changes again or a build is triggered.  A local socket accepts
+    "status" and "trigger" commands, one per connection.
+    """
+
+    def __init__(self, check, build, interval=60, debounce=300, socket_path=None):
+        self.check = check
+        self.build = build
+        self.interval = interval
+        self.debounce = debounce
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._forced = False
+        self._built_token = None
+        self._failed_token = None
+        self._seen_token = None
+        self._changed_at = None
+        self._state = "idle"
+        self._last_build = None
+        self._server = None
+
+    def status(self):
+        with self._lock:
+            return {"state": self._state, "built": self._built_token,
+                    "failed": self._failed_token, "seen": self._seen_token, "changed_at": self._changed_at,
+                    "last_build": self._last_build}
+
+    def trigger(self):
+        with self._lock:
+            self._forced = True
+        self._wakeup.set()
+
+    def _start_server(self):
+        if self.socket_path is None:
+            return
+        if os.path.exists(self.socket_path):
+            # Only a socket left behind by a daemon that died is replaced
+            if _listening(self.socket_path):
+                logger.fatal("Another daemon is already listening on %s" % self.socket_path)
+            os.unlink(self.socket_path)
+        self._server = _ControlServer(self.socket_path, _ControlHandler)
+        self._server.daemon = self
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logger.info("Listening on %s" % self.socket_path)
+
+    def _poll(self):
+        try:
+            token = self.check()
+        except (Exception, SystemExit) as e:
+            logger.error("Unable to check for changes: %s" % e)
+            return
+        with self._lock:
+            if token != self._seen_token:
+                self._seen_token = token
+                if token != self._built_token:
+                    logger.info("Change detected, building in %d seconds unless more changes come"
+                                % self.debounce)
+                    self._changed_at = time.time()
+                else:
+                    # Changes were reverted before the build started
+                    self._changed_at = None
+
+    def _run_build(self, token):
+        with self._lock:
+            self._state = "building"
+            self._forced = False
+        start = time.time()
+        success = False
+        try:
+            self.build()
+            success = True
+        except (Exception, SystemExit) as e:
+            # logger.fatal() raises SystemExit, the daemon must go on
+            logger.error("Build failed: %s" % e)
+        with self._lock:
+            self._state = "idle"
+            self._last_build = {"token": token, "success": success,
+                                "started": start, "duration": time.time() - start}
+            # Either way there's nothing to do until the next change
+            if success:
+                self._built_token = token
+                self._failed_token = None
+            else:
+                self._failed_token = token
+            self._changed_at = None
+
+    def run_once(self):
+        """Poll once and build when needed, returns True if a build ran."""
+        self._poll()
+        with self._lock:
+            token = self._seen_token
+            due = self._changed_at is not None and time.time() - self._changed_at >= self.debounce
+            forced = self._forced
+        if due or forced:
+            self._run_build(token)
+            return True
+        return False
+
+    def run(self):
+        self._start_server()
+        try:
+            while True:
+                self.run_once()
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+        finally:
+            if self._server is not None:
+                self._server.shutdown()
+                self._server.server_close()
+                os.unlink(self.socket_path)
+
+def _listening(socket_path):
+    # Whether a daemon accepts connections on @socket_path
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def send_command(socket_path, command):
+    """Send @command to a running daemon and return its reply."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            logger.fatal("No daemon listening on %s" % socket_path)
+        sock.sendall((command + "\n").encode("utf-8"))
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.decode("utf-8"))
@@ -0,0 +1,100 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import threading
+
+from .logger import Logger
+
+logger = Logger()
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+def tree_size(path):
+    """Return the space used by files in @path, sparse files count
+    for the blocks actually allocated."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            st = os.lstat(os.path.join(dirpath, filename))
+            if hasattr(st, "st_blocks"):
+                total += st.st_blocks * 512
+            else:
+                total += st.st_size
+    return total
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TiB" % size
+
+class SpaceAdmission(object):
+    """Let targets start only when there is enough free space in @path
+    for what they are expected to write.
+
+    Space needed by targets being built is reserved until they are
+    done.  A target that doesn't fit waits for the others to finish,
+    @reclaim is called once to free some space before giving up.
+    """
+
+    def __init__(self, path, min_free=0, default_size=0, headroom=1.0, reclaim=None):
+        self.path = path
+        self.min_free = min_free
+        self.default_size = default_size
+        self.headroom = headroom
+        self.reclaim = reclaim
+        self._reserved = 0
+        self._cond = threading.Condition()
+
+    def estimate(self, previous_size=None):
+        """Space needed by a target given what it used last time, with
+        some headroom for temporary files and compression."""
+        return int(self.headroom * (previous_size or self.default_size))
+
+    def _available(self):
+        return free_space(self.path) - self._reserved - self.min_free
+
+    def acquire(self, name, size):
+        """Wait until @size bytes are available for @name, return False
+        if they never will be."""
+        with self._cond:
+            while size > self._available():
+                if self._reserved > 0:
+                    logger.info("Deferring \"%s\" until other targets are done, %s needed" %
+                                (name, format_size(size)))
+                    self._cond.wait()
+                    continue
+                if self.reclaim is not None:
+                    reclaim, self.reclaim = self.reclaim, None
+                    reclaim()
+                    continue
+                logger.error("Not enough space for \"%s\": %s needed, %s available" %
+                             (name, format_size(size), format_size(max(0, self._available()))))
+                return False
+            self._reserved += size
+            return True
+
+    def release(self, size):
+        with self._cond:
+            self._reserved -= size
+            self._cond.notify_all()
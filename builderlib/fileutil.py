@@ -17,10 +17,12 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-import sys, os, json, shutil
+import sys, os, json, errno, shutil
 
 from .logger import Logger
 
+logger = Logger()
+
 def ensure_dir(path):
     if not os.path.isdir(path):
         os.makedirs(path)
@@ -28,6 +30,48 @@ def ensure_dir(path):
 def ensure_parent_dir(path):
     ensure_dir(os.path.dirname(path))
 
+def atomic_write_json(filename, data, **kwargs):
+    # Readers and crashes never see a partially written file, @kwargs
+    # are passed to json.dumps()
+    ensure_parent_dir(filename)
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(json.dumps(data, **kwargs))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+    # The rename is only durable once the directory is synced
+    fd = os.open(os.path.dirname(filename), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def lock_file(path):
+    # Take an exclusive lock on @path without waiting, return the open
+    # file holding it or None when another process already holds it
+    import fcntl
+    ensure_parent_dir(path)
+    f = open(path, "a")
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return f
+
+def parse_size(value):
+    # Sizes are given in bytes or with a K, M, G or T suffix
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = value.strip().upper()
+    units = "KMGT"
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * 1024 ** (units.index(value[-1]) + 1))
+    return int(value)
+
 def find_program_in_path(program, env=None):
     if env:
         environment = env
@@ -42,8 +86,6 @@ def find_program_in_path(program, env=None):
     return program_path
 
 def file_linkcopy(src, dest, overwrite=False):
-    logger = Logger()
-
     src_stat = os.lstat(src)
     dest_stat = os.lstat(os.path.abspath(os.path.join(dest, os.pardir)))
 
@@ -65,19 +107,46 @@ def file_linkcopy(src, dest, overwrite=False):
         os.link(src, dest)
     return True
 
-class TeeStream(object):
-    def __init__(self, name, mode):
-        self.stream = open(name, mode)
-        self.stdout = sys.stdout
-        sys.stdout = self
+# From linux/fs.h
+FICLONE = 0x40049409
 
-    def __del__(self):
-        sys.stdout = self.stdout
-        self.stream.close()
+def file_reflink(src, dest, overwrite=False):
+    # Share the extents of @src with @dest, only on filesystems
+    # supporting copy-on-write such as btrfs and xfs
+    import fcntl
+    if not overwrite and os.path.exists(dest):
+        return False
+    with open(src, "rb") as src_file:
+        with open(dest, "wb") as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dest)
+    return True
 
-    def write(self, data):
-        self.stream.write(data)
-        self.stdout.write(data)
+def tree_copy(src, dest, copyfn, exclude=None):
+    # Recreate the @src tree in @dest, copying files with @copyfn
+    # or shutil.copy2() for those matching the @exclude function
+    if not os.path.isdir(src):
+        ensure_parent_dir(dest)
+        return copyfn(src, dest)
+    for dirpath, dirnames, filenames in os.walk(src):
+        dest_dirpath = os.path.join(dest, os.path.relpath(dirpath, src))
+        ensure_dir(dest_dirpath)
+        # os.walk() lists symbolic links to directories among dirnames
+        for dirname in dirnames:
+            src_path = os.path.join(dirpath, dirname)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), os.path.join(dest_dirpath, dirname))
+        for filename in filenames:
+            src_path = os.path.join(dirpath, filename)
+            dest_path = os.path.join(dest_dirpath, filename)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dest_path)
+            elif exclude is not None and exclude(src_path):
+                shutil.copy2(src_path, dest_path)
+            elif not copyfn(src_path, dest_path):
+                return False
+    return True
 
-    def fileno(self):
-        return self.stdout.fileno()
+def tree_linkcopy(src, dest, exclude=None):
+    # Recreate the @src tree in @dest, hard linking files when possible
+    return tree_copy(src, dest, file_linkcopy, exclude)
@@ -0,0 +1,47 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import subprocess
+
+from .fileutil import ensure_dir
+from .subprocess_helpers import run_sync_get_output
+
+def git_output(args, cwd=None):
+    # Output of git as text, None if it failed
+    output = run_sync_get_output(["git"] + args, cwd=cwd, none_on_error=True)
+    if output is not None and not isinstance(output, str):
+        output = output.decode("utf-8")
+    return output
+
+def git_export(commit, dest, cwd=None, git_dir=None):
+    # Extract the tree of @commit into @dest without a checkout,
+    # returns True on success
+    args = ["git"]
+    if git_dir is not None:
+        args += ["--git-dir", git_dir]
+    ensure_dir(dest)
+    archive = subprocess.Popen(args + ["archive", "--format=tar", commit],
+                               stdout=subprocess.PIPE, cwd=cwd, close_fds=True)
+    tar = subprocess.Popen(["tar", "-x", "-C", dest], stdin=archive.stdout,
+                           close_fds=True)
+    archive.stdout.close()
+    tar.wait()
+    archive.wait()
+    return archive.returncode == 0 and tar.returncode == 0
@@ -0,0 +1,164 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import sqlite3
+
+from .fileutil import ensure_parent_dir
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    sources_commit TEXT,
+    success INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS targets (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    duration REAL,
+    size INTEGER,
+    cache TEXT,
+    reused INTEGER NOT NULL,
+    success INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS caches (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    hits INTEGER NOT NULL,
+    misses INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS targets_name ON targets (name, run_id);
+"""
+
+class BuildHistory(object):
+    """Duration, size and cache usage of targets in past runs, stored
+    in a SQLite database under the buildroot."""
+
+    def __init__(self, filename):
+        ensure_parent_dir(filename)
+        self._db = sqlite3.connect(filename)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def record(self, started, sources_commit, targets, caches, success):
+        """Record a run: @targets is a list of dictionaries with name,
+        duration, size, cache, reused and success keys, @caches maps
+        cache names to their hits, misses and size."""
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO runs (started, duration, sources_commit, success) VALUES (?, ?, ?, ?)",
+                (started, time.time() - started, sources_commit, int(success)))
+            run_id = cursor.lastrowid
+            for target in targets:
+                self._db.execute(
+                    "INSERT INTO targets (run_id, name, duration, size, cache, reused, success) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, target["name"], target.get("duration"), target.get("size"),
+                     target.get("cache"), int(target.get("reused", False)),
+                     int(target.get("success", True))))
+            for name, stats in sorted(caches.items()):
+                self._db.execute(
+                    "INSERT INTO caches (run_id, name, hits, misses, size) VALUES (?, ?, ?, ?, ?)",
+                    (run_id, name, stats["hits"], stats["misses"], stats["size"]))
+        return run_id
+
+    def durations(self, name, limit=10):
+        """Return durations of the last @limit builds of @name, the
+        most recent first.  Reused images and failures don't count."""
+        rows = self._db.execute(
+            "SELECT duration FROM targets WHERE name = ? AND reused = 0 AND success = 1 "
+            "AND duration IS NOT NULL ORDER BY run_id DESC LIMIT ?", (name, limit))
+        return [row[0] for row in rows]
+
+    def predict(self, name, samples=5):
+        """Return the expected duration of @name, the median of recent
+        builds, or None if it was never built."""
+        durations = sorted(self.durations(name, samples))
+        if not durations:
+            return None
+        middle = len(durations) // 2
+        if len(durations) % 2:
+            return durations[middle]
+        return (durations[middle - 1] + durations[middle]) / 2.0
+
+    def names(self):
+        return [row[0] for row in self._db.execute("SELECT DISTINCT name FROM targets ORDER BY name")]
+
+    def sizes(self, name, limit=10):
+        rows = self._db.execute(
+            "SELECT size FROM targets WHERE name = ? AND reused = 0 AND success = 1 "
+            "AND size IS NOT NULL ORDER BY run_id DESC LIMIT ?", (name, limit))
+        return [row[0] for row in rows]
+
+    def cache_usage(self, limit=10):
+        """Return the hits, misses and size of each cache in the last
+        @limit runs, the most recent first."""
+        rows = self._db.execute(
+            "SELECT name, hits, misses, size FROM caches WHERE run_id IN "
+            "(SELECT id FROM runs ORDER BY id DESC LIMIT ?) ORDER BY run_id DESC", (limit,))
+        result = {}
+        for name, hits, misses, size in rows:
+            result.setdefault(name, []).append((hits, misses, size))
+        return result
+
+    def report(self, threshold=30.0, limit=10):
+        """Return a table with recent durations of each target, flagging
+        those at least @threshold percent slower than the median of
+        the previous builds, and the number of regressions."""
+        lines = ["%-32s %10s %10s %8s %10s  %s" %
+                 ("Target", "Last (s)", "Median (s)", "Change", "Size (MB)", "Trend (s, oldest first)")]
+        regressions = 0
+        for name in self.names():
+            durations = self.durations(name, limit)
+            if not durations:
+                continue
+            last = durations[0]
+            previous = sorted(durations[1:])
+            flag = ""
+            if previous:
+                median = previous[len(previous) // 2]
+                change = "%+.1f%%" % (100.0 * (last - median) / median) if median else "-"
+                if median and 100.0 * (last - median) / median >= threshold:
+                    flag = "  REGRESSION"
+                    regressions += 1
+                median = "%.1f" % median
+            else:
+                median = change = "-"
+            sizes = self.sizes(name, 1)
+            size = "%.1f" % (sizes[0] / 1048576.0) if sizes else "-"
+            trend = " ".join(["%.0f" % d for d in reversed(durations)])
+            lines.append("%-32s %10.1f %10s %8s %10s  %s%s" %
+                         (name[:32], last, median, change, size, trend, flag))
+
+        usage = self.cache_usage(limit)
+        if usage:
+            lines.append("")
+            lines.append("%-20s %14s %10s" % ("Cache", "Hit rate (%)", "Size (MB)"))
+            for name, entries in sorted(usage.items()):
+                hits = sum([entry[0] for entry in entries])
+                used = hits + sum([entry[1] for entry in entries])
+                ratio = 100.0 * hits / used if used else 0.0
+                lines.append("%-20s %14.1f %10.1f" % (name[:20], ratio, entries[0][2] / 1048576.0))
+        return "\n".join(lines), regressions
@@ -0,0 +1,118 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Machine readable index of published snapshots.
+#
+# Each snapshot directory has an index.json describing its images,
+# the top level index.json lists snapshots with their images so that
+# clients don't have to crawl directory listings.  Both are updated
+# as images are published, only reading what was just published.
+
+import os
+import json
+import datetime
+
+from .fileutil import atomic_write_json
+
+INDEX_FILENAME = "index.json"
+
+def _load(filename, default):
+    if not os.path.exists(filename):
+        return default
+    try:
+        with open(filename, "r") as f:
+            return json.loads(f.read())
+    except ValueError:
+        return default
+
+def _save(filename, data, indent=None):
+    if indent is None:
+        atomic_write_json(filename, data, sort_keys=True, separators=(",", ":"))
+    else:
+        atomic_write_json(filename, data, sort_keys=True, indent=indent)
+
+def list_files(path):
+    """Return files published in @path with their size and checksum,
+    taken from SHA256SUMS files rather than computed again."""
+    result = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        sums = {}
+        if "SHA256SUMS" in filenames:
+            with open(os.path.join(dirpath, "SHA256SUMS"), "r") as f:
+                for line in f:
+                    digest, name = line.rstrip("\n").split("  ", 1)
+                    sums[name] = digest
+        for filename in sorted(filenames):
+            if filename == "SHA256SUMS":
+                continue
+            filename_path = os.path.join(dirpath, filename)
+            entry = {"path": os.path.relpath(filename_path, path),
+                     "size": os.lstat(filename_path).st_size}
+            if filename in sums:
+                entry["sha256"] = sums[filename]
+            result.append(entry)
+    return result
+
+class SnapshotIndex(object):
+    """Keep @publish_dir/index.json and the index.json of each
+    snapshot up to date."""
+
+    def __init__(self, publish_dir):
+        self.publish_dir = publish_dir
+        self.filename = os.path.join(publish_dir, INDEX_FILENAME)
+
+    def add(self, snapshot, name, path, duration=None, commit=None):
+        """Add the image @name published in @path to @snapshot."""
+        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        files = list_files(path)
+        entry = {"path": os.path.relpath(path, self.publish_dir), "files": files,
+                 "size": sum([f["size"] for f in files]), "published": now}
+        if duration is not None:
+            entry["duration"] = round(duration, 1)
+        if commit:
+            entry["commit"] = commit
+
+        snapshot_filename = os.path.join(self.publish_dir, snapshot, INDEX_FILENAME)
+        data = _load(snapshot_filename, {"snapshot": snapshot, "images": {}})
+        data["images"][name] = entry
+        data["updated"] = now
+        _save(snapshot_filename, data, indent=4)
+
+        index = _load(self.filename, {"snapshots": {}})
+        index["snapshots"][snapshot] = {
+            "index": os.path.join(snapshot, INDEX_FILENAME),
+            "images": sorted(data["images"]),
+            "size": sum([image["size"] for image in data["images"].values()]),
+            "updated": now,
+        }
+        index["latest"] = max(index["snapshots"])
+        _save(self.filename, index)
+
+    def remove(self, snapshots):
+        """Forget about @snapshots, which were removed."""
+        index = _load(self.filename, None)
+        if index is None:
+            return
+        for snapshot in snapshots:
+            index["snapshots"].pop(snapshot, None)
+        if index["snapshots"]:
+            index["latest"] = max(index["snapshots"])
+        else:
+            index.pop("latest", None)
+        _save(self.filename, index)
@@ -0,0 +1,89 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import threading
+
+from .fileutil import atomic_write_json
+
+STAGES = ("snapshot", "kickstart", "image", "ownership", "compress", "publish")
+
+class Journal(object):
+    """Progress of the current run, written to disk after each stage
+    so that a failed run can be resumed.
+
+    The snapshot and kickstart stages are global, the others are
+    recorded per target along with some information such as the
+    image path.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = None
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self._data = json.loads(f.read())
+            except ValueError:
+                self._data = None
+
+    def pending(self):
+        """Return the snapshot directory and commit of an unfinished
+        run that can be resumed, or None."""
+        with self._lock:
+            if not self._data or "snapshot" not in self._data["stages"]:
+                return None
+            info = self._data["stages"]["snapshot"]
+            if not os.path.isdir(info["path"]):
+                return None
+            return info["path"], info["commit"]
+
+    def start(self):
+        """Forget about the previous run."""
+        with self._lock:
+            self._data = {"stages": {}, "targets": {}}
+            self._save()
+
+    def done(self, stage, target=None, **info):
+        with self._lock:
+            if target is None:
+                self._data["stages"][stage] = info
+            else:
+                self._data["targets"].setdefault(target, {})[stage] = info
+            self._save()
+
+    def get(self, stage, target=None):
+        """Return information recorded when @stage was completed, None
+        if it wasn't."""
+        with self._lock:
+            if target is None:
+                return self._data["stages"].get(stage)
+            return self._data["targets"].get(target, {}).get(stage)
+
+    def finish(self):
+        """The run is over, there's nothing to resume."""
+        with self._lock:
+            self._data = None
+            if os.path.exists(self.filename):
+                os.unlink(self.filename)
+
+    def _save(self):
+        atomic_write_json(self.filename, self._data, indent=4, sort_keys=True)
@@ -0,0 +1,89 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+
+from .logger import Logger
+from .subprocess_helpers import run_sync
+from .fileutil import ensure_dir
+from .buildstate import fingerprint
+
+logger = Logger()
+
+def _list_kickstarts(path):
+    # Map kickstart file names to their modification time
+    result = {}
+    for filename in os.listdir(path):
+        if filename.endswith(".ks"):
+            result[filename] = os.stat(os.path.join(path, filename)).st_mtime
+    return result
+
+def _list_configs(sources_dir):
+    # Configurations may include each other, so every one of them
+    # is part of the key
+    result = []
+    for dirpath, dirnames, filenames in os.walk(sources_dir):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        for filename in filenames:
+            if filename.endswith((".yaml", ".yml")):
+                result.append(os.path.join(dirpath, filename))
+    return sorted(result)
+
+def generate_kickstarts(configs, sdk_cmd, sources_dir, cache_dir, inputs=(), capture=None,
+                        sessions=None):
+    """Create kickstart files for each distinct configuration.
+
+    Generated files are stored in @cache_dir, keyed by the contents of
+    the configuration files and @inputs, and copied into @sources_dir
+    next time instead of running kickstarter again.  Kickstarter runs
+    in one of @sessions, a ChrootSessionPool, if given.
+    """
+    all_configs = _list_configs(sources_dir)
+    for config in sorted(set(configs)):
+        digest = fingerprint(all_configs, [config] + list(inputs))
+        config_cache_dir = os.path.join(cache_dir, digest)
+
+        if os.path.isdir(config_cache_dir):
+            logger.info("Reusing kickstart files of \"%s\"" % config)
+            os.utime(config_cache_dir, None)
+            for filename in os.listdir(config_cache_dir):
+                shutil.copy2(os.path.join(config_cache_dir, filename), sources_dir)
+            continue
+
+        before = _list_kickstarts(sources_dir)
+        cmd = ["cd", "/parentroot" + sources_dir, ";",
+               "maui-kickstarter", "-e", ".", "-c", config]
+        if sessions is not None:
+            sessions.run_sync(cmd, capture=capture)
+        else:
+            run_sync([sdk_cmd] + cmd, capture=capture)
+        after = _list_kickstarts(sources_dir)
+
+        # Save new and updated files, renaming the directory at the end
+        # so that a partial cache entry is never used
+        tmp_dir = config_cache_dir + ".tmp"
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        ensure_dir(tmp_dir)
+        for filename, mtime in after.items():
+            if before.get(filename) != mtime:
+                shutil.copy2(os.path.join(sources_dir, filename), tmp_dir)
+        os.rename(tmp_dir, config_cache_dir)
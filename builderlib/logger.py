@@ -17,7 +17,17 @@
 # Free Software Foundation, Inc., 59 Temple Place - Suite 330,
 # Boston, MA 02111-1307, USA.
 
-import os, sys, logging
+import os
+import sys
+import json
+import atexit
+import logging
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 try:
     from termcolor import colored
@@ -25,51 +35,177 @@ except ImportError:
     def colored(message, *args, **kwargs):
         return message
 
+# Custom levels
+ACTION = logging.INFO + 1
+FATAL = 100
+
+_COLORMAP = {
+    logging.INFO: dict(color="cyan"),
+    ACTION: dict(color="blue", attrs=["bold"]),
+    logging.WARNING: dict(color="yellow", attrs=["bold"]),
+    logging.ERROR: dict(color="red"),
+    logging.CRITICAL: dict(color="red", attrs=["bold"]),
+    FATAL: dict(color="red", attrs=["bold"]),
+}
+
+_PREFIXES = {
+    logging.WARNING: "WARNING: ",
+    logging.ERROR: "ERROR: ",
+    logging.CRITICAL: "CRITICAL: ",
+    FATAL: "FATAL: ",
+}
+
+class _TextFormatter(logging.Formatter):
+    # Messages are colored only when they are actually emitted
+    def format(self, record):
+        message = record.getMessage()
+        if record.levelno in _COLORMAP:
+            message = colored(message, **_COLORMAP[record.levelno])
+        text = "%s %s: %s%s" % (self.formatTime(record, "%c"), record.name,
+                                _PREFIXES.get(record.levelno, ""), message)
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+class _JsonFormatter(logging.Formatter):
+    # One JSON object per line, for machine ingestion
+    def format(self, record):
+        data = {"time": record.created, "level": record.levelname,
+                "name": record.name, "thread": record.threadName,
+                "message": record.getMessage()}
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, sort_keys=True)
+
+class _QueueHandler(logging.Handler):
+    # Hand records over to the listener thread, so that logging
+    # never blocks on the output stream
+    def __init__(self, backend):
+        logging.Handler.__init__(self)
+        self.backend = backend
+
+    def emit(self, record):
+        # Exception information can't be formatted later
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.backend.put(record)
+
+class _Backend(object):
+    # Process wide logging backend, set up only once
+
+    def __init__(self):
+        logging.addLevelName(ACTION, "ACTION")
+        logging.addLevelName(FATAL, "FATAL")
+
+        self.handler = logging.StreamHandler(sys.stderr)
+        self.handler.setFormatter(_TextFormatter())
+
+        self.logger = logging.getLogger(os.path.basename(sys.argv[0]))
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.logger.addHandler(_QueueHandler(self))
+
+        self._start()
+        # Only the thread calling fork() survives in the child
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._start)
+        atexit.register(self.flush)
+
+    def _start(self):
+        # Records queued before a fork are written by the parent
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._listen, args=(self.queue,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _check_fork(self):
+        # Without os.register_at_fork() the child notices on first use
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._start()
+
+    def put(self, record):
+        self._check_fork()
+        self.queue.put(record)
+
+    def _listen(self, queue):
+        while True:
+            record = queue.get()
+            try:
+                if record.exc_text:
+                    record.msg = "%s\n%s" % (record.getMessage(), record.exc_text)
+                    record.args = None
+                    record.exc_text = None
+                self.handler.handle(record)
+            except Exception:
+                pass
+            finally:
+                queue.task_done()
+
+    def flush(self):
+        self._check_fork()
+        self.queue.join()
+        try:
+            self.handler.flush()
+        except ValueError:
+            # The stream was closed already at exit
+            pass
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _Backend()
+    return _backend
+
+def configure(json_lines=False, stream=None):
+    """Change the output format or stream of every logger."""
+    backend = _get_backend()
+    backend.flush()
+    if stream is not None:
+        backend.handler = logging.StreamHandler(stream)
+    backend.handler.setFormatter(_JsonFormatter() if json_lines else _TextFormatter())
+
+def flush():
+    """Wait until all pending messages are written."""
+    _get_backend().flush()
+
 class Logger(object):
     def __init__(self):
-        # Setup the logger
-        logging.basicConfig(format="%(asctime)s %(name)s: %(prefix)s%(message)s",
-                            datefmt="%c")
-        self._logger = logging.getLogger(os.path.basename(sys.argv[0]))
-        self._logger.setLevel(logging.DEBUG)
-
-        # Add custom level for action
-        logging.ACTION = logging.INFO + 1
-        logging.addLevelName(logging.ACTION, "ACTION")
-        def action(self, message, *args, **kwargs):
-            self._log(logging.ACTION, message, args, **kwargs)
-        logging.Logger.action = action
- 
-        # Add custom level for fatal
-        logging.FATAL = 100
-        logging.addLevelName(logging.FATAL, "FATAL")
-        def fatal(self, message, *args, **kwargs):
-            self._log(logging.FATAL, message, args, **kwargs)
-            sys.exit(1)
-        logging.Logger.fatal = fatal
-
-        # Color dictionary
-        self._colormap = dict(
-            info = dict(color="cyan"),
-            action = dict(color="blue", attrs=["bold"]),
-            warn = dict(color="yellow", attrs=["bold"]),
-            warning = dict(color="yellow", attrs=["bold"]),
-            error = dict(color="red"),
-            critical = dict(color="red", attrs=["bold"]),
-            fatal = dict(color="red", attrs=["bold"])
-        )
+        self._logger = _get_backend().logger
+
+    def debug(self, message, *args):
+        self._logger.log(logging.DEBUG, message, *args)
+
+    def info(self, message, *args):
+        self._logger.log(logging.INFO, message, *args)
+
+    def action(self, message, *args):
+        self._logger.log(ACTION, message, *args)
+
+    def warning(self, message, *args):
+        self._logger.log(logging.WARNING, message, *args)
+
+    warn = warning
+
+    def error(self, message, *args):
+        self._logger.log(logging.ERROR, message, *args)
+
+    def critical(self, message, *args):
+        self._logger.log(logging.CRITICAL, message, *args)
+
+    def fatal(self, message, *args):
+        self._logger.log(FATAL, message, *args)
+        flush()
+        sys.exit(1)
 
     def __getattr__(self, name):
-        if name in ("debug", "info", "action", "warn", "warning", "error", "critical", "fatal"):
-            extra = {"prefix": ""}
-            if name in ("warn", "warning"):
-                extra["prefix"] = "WARNING: "
-            elif name == "error":
-                extra["prefix"] = "ERROR: "
-            elif name == "critical":
-                extra["prefix"] = "CRITICAL: "
-            elif name == "fatal":
-                extra["prefix"] = "FATAL: "
-            return lambda s, *args: getattr(self._logger, name)(
-                colored(s, **self._colormap[name]) if name != "debug" else s, *args, extra=extra)
         return getattr(self._logger, name)
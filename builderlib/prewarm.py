@@ -0,0 +1,354 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import re
+import bz2
+import gzip
+import shlex
+import shutil
+import hashlib
+import tempfile
+import threading
+import xml.etree.ElementTree as ElementTree
+from io import BytesIO
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlsplit, urljoin
+    from queue import Queue
+except ImportError:
+    import httplib
+    from urlparse import urlsplit, urljoin
+    from Queue import Queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from .logger import Logger
+from .fileutil import ensure_dir
+
+logger = Logger()
+
+REPO_NS = "{http://linux.duke.edu/metadata/repo}"
+COMMON_NS = "{http://linux.duke.edu/metadata/common}"
+RPM_NS = "{http://linux.duke.edu/metadata/rpm}"
+
+def parse_kickstart(filename):
+    """Return repositories and packages of a kickstart file.
+
+    Repositories are (name, baseurl) tuples, package groups and
+    excluded packages are left out.
+    """
+    repos = []
+    packages = []
+    in_packages = False
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if in_packages:
+                if line.startswith("%end"):
+                    in_packages = False
+                elif not line.startswith(("@", "-", "%")):
+                    packages.append(line)
+            elif line.startswith("%packages"):
+                in_packages = True
+            elif line.startswith("repo "):
+                options = {}
+                args = shlex.split(line)[1:]
+                for i, arg in enumerate(args):
+                    if "=" in arg:
+                        key, value = arg.split("=", 1)
+                        options[key] = value
+                    elif arg.startswith("--") and i + 1 < len(args):
+                        options[arg] = args[i + 1]
+                if "--baseurl" in options:
+                    repos.append((options.get("--name", options["--baseurl"]), options["--baseurl"]))
+    return repos, packages
+
+class ConnectionPool(object):
+    """Keep one connection for each host per thread, so that many
+    packages are fetched over the same connection."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connection(self, scheme, netloc, reset=False):
+        connections = self._local.__dict__.setdefault("connections", {})
+        key = (scheme, netloc)
+        if reset and key in connections:
+            connections.pop(key).close()
+        if key not in connections:
+            if scheme == "https":
+                connections[key] = httplib.HTTPSConnection(netloc, timeout=60)
+            else:
+                connections[key] = httplib.HTTPConnection(netloc, timeout=60)
+        return connections[key]
+
+    def fetch(self, url, fileobj):
+        parts = urlsplit(url)
+        if parts.scheme == "file":
+            with open(parts.path, "rb") as f:
+                fileobj.write(f.read())
+            return
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        for attempt in range(2):
+            # Servers may close idle connections, retry once with a new one
+            connection = self._connection(parts.scheme, parts.netloc, reset=attempt > 0)
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+            except (httplib.HTTPException, IOError, OSError):
+                if attempt > 0:
+                    raise
+                continue
+            if response.status != 200:
+                response.read()
+                raise IOError("Unable to fetch %s: HTTP %d" % (url, response.status))
+            while True:
+                data = response.read(1024 * 1024)
+                if not data:
+                    break
+                fileobj.write(data)
+            return
+
+    def get(self, url):
+        buf = BytesIO()
+        self.fetch(url, buf)
+        return buf.getvalue()
+
+def _decompress(filename, data):
+    if filename.endswith(".gz"):
+        return gzip.GzipFile(fileobj=BytesIO(data)).read()
+    if filename.endswith(".bz2"):
+        return bz2.decompress(data)
+    if filename.endswith(".xz") and lzma is not None:
+        return lzma.decompress(data)
+    return data
+
+# Version segments compared by rpm, anything else separates them
+_version_re = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+
+def rpmvercmp(a, b):
+    """Compare two version or release strings the way rpm does,
+    returns a negative, zero or positive number."""
+    if a == b:
+        return 0
+    one = _version_re.findall(a)
+    two = _version_re.findall(b)
+    for i in range(max(len(one), len(two))):
+        x = one[i] if i < len(one) else None
+        y = two[i] if i < len(two) else None
+        # A tilde sorts before anything, even the end of the version
+        if x == "~" or y == "~":
+            if x != y:
+                return -1 if x == "~" else 1
+            continue
+        # A caret sorts after the end of the version but before anything else
+        if x == "^" or y == "^":
+            if x is None:
+                return -1
+            if y is None:
+                return 1
+            if x != y:
+                return 1 if y == "^" else -1
+            continue
+        if x is None or y is None:
+            return 1 if y is None else -1
+        # Numbers are newer than letters
+        if x.isdigit() != y.isdigit():
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x, y = x.lstrip("0"), y.lstrip("0")
+            if len(x) != len(y):
+                return 1 if len(x) > len(y) else -1
+        if x != y:
+            return 1 if x > y else -1
+    return 0
+
+def compare_evr(a, b):
+    """Compare (epoch, version, release) tuples the way rpm does."""
+    if int(a[0] or 0) != int(b[0] or 0):
+        return 1 if int(a[0] or 0) > int(b[0] or 0) else -1
+    return rpmvercmp(a[1], b[1]) or rpmvercmp(a[2], b[2])
+
+def fetch_primary(pool, baseurl):
+    """Return a dictionary of packages available in a repository, with
+    the newest version of each one."""
+    if not baseurl.endswith("/"):
+        baseurl += "/"
+    repomd = ElementTree.fromstring(pool.get(urljoin(baseurl, "repodata/repomd.xml")))
+    location = None
+    for data in repomd.findall(REPO_NS + "data"):
+        if data.get("type") == "primary":
+            location = data.find(REPO_NS + "location").get("href")
+    if location is None:
+        return {}
+
+    packages = {}
+    primary = _decompress(location, pool.get(urljoin(baseurl, location)))
+    for package in ElementTree.fromstring(primary).findall(COMMON_NS + "package"):
+        if package.get("type") != "rpm" or package.findtext(COMMON_NS + "arch") == "src":
+            continue
+        checksum = package.find(COMMON_NS + "checksum")
+        fmt = package.find(COMMON_NS + "format")
+        provides = [entry.get("name") for entry in fmt.findall(RPM_NS + "provides/" + RPM_NS + "entry")]
+        provides += [f.text for f in fmt.findall(COMMON_NS + "file")]
+        requires = [entry.get("name") for entry in fmt.findall(RPM_NS + "requires/" + RPM_NS + "entry")]
+        version = package.find(COMMON_NS + "version")
+        if version is None:
+            evr = ("0", "", "")
+        else:
+            evr = (version.get("epoch", "0"), version.get("ver", ""), version.get("rel", ""))
+        info = {
+            "name": package.findtext(COMMON_NS + "name"),
+            "url": urljoin(baseurl, package.find(COMMON_NS + "location").get("href")),
+            "location": package.find(COMMON_NS + "location").get("href"),
+            "checksum": (checksum.get("type"), checksum.text),
+            "provides": provides,
+            "requires": [r for r in requires if not r.startswith("rpmlib(")],
+            "evr": evr,
+        }
+        # Repositories may keep older versions, mic installs the newest
+        current = packages.get(info["name"])
+        if current is None or compare_evr(evr, current["evr"]) > 0:
+            packages[info["name"]] = info
+    return packages
+
+def resolve(names, repos):
+    """Return packages needed to install @names, following dependencies.
+
+    @repos is a list of (repo name, packages) tuples, the first
+    repository providing something wins.
+    """
+    providers = {}
+    for repo_name, packages in repos:
+        for package in packages.values():
+            for capability in [package["name"]] + package["provides"]:
+                providers.setdefault(capability, (repo_name, package))
+
+    result = {}
+    queue = list(names)
+    while queue:
+        name = queue.pop()
+        if name not in providers:
+            continue
+        repo_name, package = providers[name]
+        key = (repo_name, package["location"])
+        if key in result:
+            continue
+        result[key] = package
+        queue.extend(package["requires"])
+    return result
+
+class Prewarmer(object):
+    """Fetch packages of all targets into the packages caches before
+    mic runs, @jobs downloads at a time."""
+
+    def __init__(self, cache_dir, package_cache, jobs=8):
+        self.cache_dir = cache_dir
+        self.package_cache = package_cache
+        self.jobs = max(1, int(jobs))
+        self._pool = ConnectionPool()
+        self._logger = logger
+
+    def _download(self, package, dests, tmp_dir):
+        algorithm, expected = package["checksum"]
+        fd, tmp_filename = tempfile.mkstemp(dir=tmp_dir, suffix=".rpm")
+        with os.fdopen(fd, "wb") as f:
+            self._pool.fetch(package["url"], f)
+        hasher = hashlib.new("sha1" if algorithm == "sha" else algorithm)
+        with open(tmp_filename, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(data)
+        if hasher.hexdigest() != expected:
+            os.unlink(tmp_filename)
+            raise IOError("Checksum mismatch for %s" % package["url"])
+
+        # The same package is often needed by more than one cache
+        result = [(tmp_filename, dests[0])]
+        for dest in dests[1:]:
+            link_filename = tempfile.mktemp(dir=tmp_dir, suffix=".rpm")
+            os.link(tmp_filename, link_filename)
+            result.append((link_filename, dest))
+        return result
+
+    def _worker(self, queue, results, tmp_dir):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            package, dests = item
+            try:
+                results.extend(self._download(package, dests, tmp_dir))
+            except (IOError, OSError, httplib.HTTPException) as e:
+                self._logger.warning("%s" % e)
+
+    def run(self, kickstarts):
+        """Fetch packages for @kickstarts, a list of (kickstart file, cache
+        name) tuples."""
+        repodata = {}
+        wanted = {}
+        for filename, cache_name in kickstarts:
+            repos, names = parse_kickstart(filename)
+            metadata = []
+            for repo_name, baseurl in repos:
+                if baseurl not in repodata:
+                    try:
+                        repodata[baseurl] = fetch_primary(self._pool, baseurl)
+                    except (IOError, OSError, httplib.HTTPException, ElementTree.ParseError) as e:
+                        self._logger.warning("Unable to read metadata of %s: %s" % (baseurl, e))
+                        repodata[baseurl] = {}
+                metadata.append((repo_name, repodata[baseurl]))
+            for (repo_name, location), package in resolve(names, metadata).items():
+                # Same layout as the zypp backend of mic
+                dest = os.path.join(self.cache_dir, cache_name, "packages", repo_name, location)
+                if not os.path.exists(dest):
+                    wanted.setdefault(package["url"], (package, []))[1].append(dest)
+
+        self._logger.info("Prewarming packages caches with %d packages" % len(wanted))
+        if not wanted:
+            return 0
+
+        # Nothing created the caches yet on the first run
+        ensure_dir(self.cache_dir)
+        tmp_dir = tempfile.mkdtemp(prefix=".prewarm-", dir=self.cache_dir)
+        queue = Queue()
+        results = []
+        threads = []
+        for i in range(min(self.jobs, len(wanted))):
+            thread = threading.Thread(target=self._worker, args=(queue, results, tmp_dir))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for url in sorted(wanted):
+            queue.put(wanted[url])
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+        self.package_cache.import_files(results)
+        shutil.rmtree(tmp_dir)
+        self._logger.info("Prewarmed %d packages" % len(results))
+        return len(results)
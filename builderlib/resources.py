@@ -0,0 +1,204 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Limit what each target can use so that targets built at the same
+# time don't starve each other.
+#
+# Settings are applied by wrapping commands with taskset, nice and
+# ionice, and by moving them into a cgroup v2 subtree for memory and
+# I/O weight; children inherit all of them.
+
+import os
+import errno
+import threading
+
+from .logger import Logger
+from .fileutil import parse_size
+
+logger = Logger()
+
+BLOCK_SIZE = 512
+
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+def cgroup2_available(path="/sys/fs/cgroup"):
+    return os.path.exists(os.path.join(path, "cgroup.controllers"))
+
+def _write(path, value):
+    with open(path, "w") as f:
+        f.write(value)
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except IOError:
+        return None
+
+class ResourceProfile(object):
+    """Resources a target can use.
+
+    @cpus is a CPU list for taskset such as "0-3", @nice the niceness,
+    @ionice a class optionally followed by a level such as
+    "best-effort:7", @memory_max and @io_weight need a cgroup v2
+    subtree at @cgroup_root where a cgroup named @name is created.
+    """
+
+    def __init__(self, name, cpus=None, nice=None, ionice=None, memory_max=None,
+                 io_weight=None, cgroup_root=None):
+        self.name = name
+        self.cpus = cpus
+        self.nice = nice
+        self.ionice = ionice
+        self.memory_max = memory_max
+        self.io_weight = io_weight
+        self.cgroup_root = cgroup_root
+        self._cgroup = None
+        self._cgroup_failed = False
+        self._lock = threading.Lock()
+        self._usage = {"cpu": 0.0, "memory": 0, "read": 0, "write": 0}
+        self._accounted = False
+
+    @classmethod
+    def from_settings(cls, name, settings, cgroup_root=None):
+        memory_max = settings.get("memory_max")
+        if memory_max is not None:
+            memory_max = parse_size(memory_max)
+        return cls(name, settings.get("cpus"), settings.get("nice"), settings.get("ionice"),
+                   memory_max, settings.get("io_weight"), cgroup_root)
+
+    def empty(self):
+        return self.cpus is None and self.nice is None and self.ionice is None \
+            and self.memory_max is None and self.io_weight is None
+
+    def _setup_cgroup(self):
+        # Create the cgroup the first time a command needs it
+        if self._cgroup is not None or self._cgroup_failed:
+            return self._cgroup
+        if self.cgroup_root is None or (self.memory_max is None and self.io_weight is None):
+            return None
+        path = os.path.join(self.cgroup_root, self.name)
+        try:
+            if not os.path.isdir(self.cgroup_root):
+                os.mkdir(self.cgroup_root)
+            _write(os.path.join(self.cgroup_root, "cgroup.subtree_control"), "+memory +io +cpu")
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            if self.memory_max is not None:
+                _write(os.path.join(path, "memory.max"), "%d" % self.memory_max)
+            if self.io_weight is not None:
+                _write(os.path.join(path, "io.weight"), "default %d" % self.io_weight)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to set up cgroup %s, memory and I/O of \"%s\" are not limited: %s" %
+                           (path, self.name, e))
+            self._cgroup_failed = True
+            return None
+        self._cgroup = path
+        return path
+
+    def wrap(self, args, root=""):
+        """Return @args with commands applying the profile in front,
+        @root is where the host filesystem is for commands running in
+        the SDK chroot."""
+        args = list(args)
+        if self.ionice is not None:
+            parts = self.ionice.split(":")
+            prefix = ["ionice", "-c", IONICE_CLASSES.get(parts[0], parts[0])]
+            if len(parts) > 1:
+                prefix += ["-n", parts[1]]
+            args = prefix + args
+        if self.nice is not None:
+            args = ["nice", "-n", "%d" % self.nice] + args
+        if self.cpus is not None:
+            args = ["taskset", "-c", "%s" % self.cpus] + args
+        with self._lock:
+            cgroup = self._setup_cgroup()
+        if cgroup is not None:
+            args = ["sh", "-c", 'echo $$ > "$0/cgroup.procs" && exec "$@"', root + cgroup] + args
+        return args
+
+    def add_rusage(self, rusage):
+        """Account a command that ran with this profile."""
+        if rusage is None:
+            return
+        with self._lock:
+            self._accounted = True
+            self._usage["cpu"] += rusage["utime"] + rusage["stime"]
+            self._usage["memory"] = max(self._usage["memory"], rusage["maxrss"] * 1024)
+            self._usage["read"] += rusage["inblock"] * BLOCK_SIZE
+            self._usage["write"] += rusage["oublock"] * BLOCK_SIZE
+
+    def _cgroup_usage(self):
+        usage = {"cpu": 0.0, "memory": 0, "read": 0, "write": 0}
+        for line in (_read(os.path.join(self._cgroup, "cpu.stat")) or "").splitlines():
+            key, value = line.split()
+            if key == "usage_usec":
+                usage["cpu"] = int(value) / 1000000.0
+        peak = _read(os.path.join(self._cgroup, "memory.peak"))
+        if peak:
+            usage["memory"] = int(peak)
+        for line in (_read(os.path.join(self._cgroup, "io.stat")) or "").splitlines():
+            for field in line.split()[1:]:
+                key, value = field.split("=")
+                if key == "rbytes":
+                    usage["read"] += int(value)
+                elif key == "wbytes":
+                    usage["write"] += int(value)
+        return usage
+
+    def usage(self):
+        """Return CPU seconds, peak memory and bytes read and written,
+        or None when nothing was accounted."""
+        with self._lock:
+            if self._cgroup is not None:
+                return self._cgroup_usage()
+            if not self._accounted:
+                return None
+            return dict(self._usage)
+
+    def close(self):
+        """Remove the cgroup, killing whatever is left in it."""
+        with self._lock:
+            if self._cgroup is None:
+                return
+            path, self._cgroup = self._cgroup, None
+        if (_read(os.path.join(path, "cgroup.procs")) or "").strip():
+            try:
+                _write(os.path.join(path, "cgroup.kill"), "1")
+            except (IOError, OSError):
+                pass
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                logger.warning("Unable to remove cgroup %s: %s" % (path, e))
+
+def usage_report(profiles):
+    """Return a table with resources used by each profile."""
+    lines = ["%-32s %10s %12s %10s %10s" %
+             ("Target", "CPU (s)", "Memory (MB)", "Read (MB)", "Write (MB)")]
+    for profile in profiles:
+        usage = profile.usage()
+        if usage is None:
+            lines.append("%-32s %10s %12s %10s %10s" % (profile.name[:32], "-", "-", "-", "-"))
+            continue
+        lines.append("%-32s %10.1f %12.1f %10.1f %10.1f" %
+                     (profile.name[:32], usage["cpu"], usage["memory"] / 1048576.0,
+                      usage["read"] / 1048576.0, usage["write"] / 1048576.0))
+    return "\n".join(lines)
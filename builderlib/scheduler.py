@@ -0,0 +1,106 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import threading
+
+from .logger import Logger
+
+logger = Logger()
+
+class Job(object):
+    def __init__(self, name, func, args=(), locks=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.locks = frozenset(locks)
+        self.result = None
+        self.error = None
+
+class Scheduler(object):
+    """Run jobs concurrently, up to @jobs at a time.
+
+    Each job may name a set of locks; two jobs sharing a lock never
+    run at the same time.  A job waiting for a lock does not hold a
+    worker slot, so other jobs can run in the meantime.
+    """
+
+    def __init__(self, jobs=1, keep_going=False):
+        self.jobs = max(1, int(jobs))
+        self.keep_going = keep_going
+        self._logger = logger
+        self._pending = []
+        self._all = []
+        self._held = set()
+        self._failed = False
+        self._cond = threading.Condition()
+
+    def add(self, name, func, args=(), locks=()):
+        job = Job(name, func, args, locks)
+        self._pending.append(job)
+        self._all.append(job)
+        return job
+
+    def _next_job(self):
+        # Called with the condition held, returns None when there's
+        # nothing left to schedule
+        while True:
+            if not self._pending or (self._failed and not self.keep_going):
+                return None
+            for job in self._pending:
+                if not (job.locks & self._held):
+                    self._pending.remove(job)
+                    self._held |= job.locks
+                    return job
+            self._cond.wait()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.result = job.func(*job.args)
+            except (Exception, SystemExit) as e:
+                # logger.fatal() exits, which in a thread only raises SystemExit
+                job.error = e
+                if isinstance(e, SystemExit):
+                    self._logger.error("Job \"%s\" failed" % job.name)
+                else:
+                    self._logger.error("Job \"%s\" failed: %s" % (job.name, e))
+            with self._cond:
+                self._held -= job.locks
+                if job.error is not None:
+                    self._failed = True
+                self._cond.notify_all()
+
+    def run(self):
+        """Run all jobs and return them in the order they were added."""
+        threads = []
+        for i in range(min(self.jobs, len(self._pending))):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return list(self._all)
+
+    def failed(self):
+        return [job for job in self._all if job.error is not None]
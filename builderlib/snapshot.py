@@ -0,0 +1,80 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import time
+import shutil
+
+from .logger import Logger
+from .subprocess_helpers import run_sync_get_output
+from .fileutil import file_reflink, tree_copy, tree_linkcopy
+from .gitutil import git_export
+
+logger = Logger()
+
+def _snapshot_reflink(src, dest):
+    return tree_copy(src, dest, file_reflink)
+
+def _snapshot_git(src, dest):
+    # Only HEAD is exported, local modifications would be lost
+    if not os.path.isdir(os.path.join(src, ".git")):
+        return False
+    status = run_sync_get_output(["git", "status", "--porcelain"], cwd=src,
+                                 none_on_error=True)
+    if status is None or status:
+        return False
+    return git_export("HEAD", dest, cwd=src)
+
+def _snapshot_hardlink(src, dest):
+    # Kickstart files are regenerated in the snapshot, writing them through
+    # a hard link would modify the original checkout
+    return tree_linkcopy(src, dest, exclude=lambda path: path.endswith(".ks"))
+
+def _snapshot_copy(src, dest):
+    shutil.copytree(src, dest, symlinks=True)
+    return True
+
+STRATEGIES = [
+    ("reflink", _snapshot_reflink),
+    ("git", _snapshot_git),
+    ("hardlink", _snapshot_hardlink),
+    ("copy", _snapshot_copy),
+]
+
+def create_snapshot(src, dest, strategy="auto"):
+    """Make a copy of @src in @dest trying the cheapest strategy first.
+
+    Returns the name of the strategy that was used.
+    """
+    for name, func in STRATEGIES:
+        if strategy not in ("auto", name):
+            continue
+        start = time.time()
+        try:
+            success = func(src, dest)
+        except (IOError, OSError):
+            success = False
+        if success:
+            logger.info("Snapshot of %s created with %s in %.2f seconds" %
+                        (src, name, time.time() - start))
+            return name
+        # Start over with the next strategy
+        if os.path.lexists(dest):
+            shutil.rmtree(dest)
+    logger.fatal("Unable to create a snapshot of %s" % src)
@@ -0,0 +1,147 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Kickstarter configurations assembled from several repositories.
+#
+# Each source is kept in a bare mirror under the build root.  Only the
+# commit its ref points to is fetched, without history and, unless the
+# filter is turned off, without blobs: those needed by the snapshot are
+# downloaded in a batch when it's exported.
+
+import os
+import re
+
+from .logger import Logger
+from .fileutil import ensure_dir
+from .gitutil import git_output, git_export
+from .scheduler import Scheduler
+from .subprocess_helpers import run_sync
+
+logger = Logger()
+
+RESOLVED_REF = "refs/mauibuild/resolved"
+
+_sha_re = re.compile("^[0-9a-f]{40}$")
+
+class Source(object):
+    def __init__(self, name, url, ref="master", path="", depth=1, filter="blob:none"):
+        self.name = name
+        self.url = url
+        self.ref = ref
+        self.path = path
+        self.depth = depth
+        self.filter = filter
+
+    def pinned(self):
+        """Whether the ref is a commit id rather than a branch or tag."""
+        return _sha_re.match(self.ref) is not None
+
+def parse_sources(entries):
+    """Return the sources declared in the manifest."""
+    sources = []
+    for entry in entries:
+        sources.append(Source(entry["name"], entry["url"], entry.get("ref", "master"),
+                              entry.get("path", ""), entry.get("depth", 1),
+                              entry.get("filter", "blob:none")))
+    return sources
+
+class SourceMirrors(object):
+    """Bare mirrors of the sources in @mirrors_dir."""
+
+    def __init__(self, mirrors_dir):
+        self.mirrors_dir = mirrors_dir
+
+    def mirror_path(self, source):
+        return os.path.join(self.mirrors_dir, source.name + ".git")
+
+    def _git(self, source, args):
+        run_sync(["git", "--git-dir", self.mirror_path(source)] + args,
+                 log_initiation=False, log_success=False)
+
+    def _ensure_mirror(self, source):
+        mirror = self.mirror_path(source)
+        if not os.path.isdir(mirror):
+            logger.info("Creating a mirror of %s" % source.url)
+            ensure_dir(self.mirrors_dir)
+            run_sync(["git", "init", "-q", "--bare", mirror], log_initiation=False, log_success=False)
+            self._git(source, ["remote", "add", "origin", source.url])
+        else:
+            self._git(source, ["remote", "set-url", "origin", source.url])
+        if source.filter:
+            # Objects left out by the filter are fetched on demand
+            for key, value in [("core.repositoryformatversion", "1"),
+                               ("extensions.partialClone", "origin"),
+                               ("remote.origin.promisor", "true"),
+                               ("remote.origin.partialclonefilter", source.filter)]:
+                self._git(source, ["config", key, value])
+
+    def fetch(self, source):
+        """Fetch the commit @source points to and return its id."""
+        self._ensure_mirror(source)
+        args = ["fetch", "-q", "--no-tags", "--depth", str(source.depth)]
+        if source.filter:
+            args += ["--filter", source.filter]
+        self._git(source, args + ["origin", "+%s:%s" % (source.ref, RESOLVED_REF)])
+        commit = git_output(["--git-dir", self.mirror_path(source), "rev-parse",
+                              RESOLVED_REF + "^{commit}"])
+        logger.info("Source %s is at %s (%s)" % (source.name, commit, source.ref))
+        return commit
+
+    def resolve(self, sources):
+        """Fetch all sources at the same time, returns a dictionary
+        mapping each source name to a commit id."""
+        scheduler = Scheduler(len(sources), keep_going=True)
+        for source in sources:
+            scheduler.add(source.name, self.fetch, (source,), locks=[source.name])
+        jobs = scheduler.run()
+        failed = scheduler.failed()
+        if failed:
+            logger.fatal("Unable to fetch sources: %s" % ", ".join([job.name for job in failed]))
+        return dict([(job.name, job.result) for job in jobs])
+
+    def export(self, sources, commits, dest):
+        """Extract the resolved commit of each source into its path
+        inside @dest."""
+        for source in sources:
+            path = os.path.join(dest, source.path)
+            if not git_export(commits[source.name], path, git_dir=self.mirror_path(source)):
+                logger.fatal("Unable to export source %s to %s" % (source.name, path))
+
+def remote_commits(sources):
+    """Ask each remote which commit the refs point to, this is much
+    cheaper than fetching."""
+    commits = {}
+    for source in sources:
+        if source.pinned():
+            commits[source.name] = source.ref
+            continue
+        output = git_output(["ls-remote", source.url, source.ref])
+        refs = dict([tuple(reversed(line.split())) for line in (output or "").splitlines()])
+        commits[source.name] = None
+        # Annotated tags are peeled to the commit they point to
+        for name in [source.ref, "refs/heads/" + source.ref,
+                     "refs/tags/" + source.ref + "^{}", "refs/tags/" + source.ref]:
+            if name in refs:
+                commits[source.name] = refs[name]
+                break
+    return commits
+
+def combined_commit(commits):
+    """A single string identifying the commits of all sources."""
+    return " ".join(["%s:%s" % item for item in sorted(commits.items())])
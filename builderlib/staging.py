@@ -0,0 +1,129 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Build images in a RAM backed staging area.
+#
+# mic writes lots of small files while it assembles the root file
+# system, doing that on a tmpfs keeps the build disk for the packages
+# cache and published images.  Only the final image is moved to disk.
+
+import os
+import re
+import tempfile
+import threading
+
+from .logger import Logger
+from .fileutil import ensure_dir
+from .diskspace import free_space, format_size
+from .subprocess_helpers import run_sync
+
+logger = Logger()
+
+def mem_available():
+    """Return memory available without swapping, in bytes, or None
+    when the kernel doesn't say."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+def filesystem_type(path):
+    """Return the type of the file system @path is on, such as "tmpfs",
+    or None when it can't be found."""
+    path = os.path.realpath(path)
+    result = None
+    longest = -1
+    try:
+        with open("/proc/self/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and other characters are escaped in octal
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[1])
+                prefix = mount_point.rstrip("/") + "/"
+                if (path == mount_point or path.startswith(prefix)) and len(mount_point) >= longest:
+                    result = fields[2]
+                    longest = len(mount_point)
+    except IOError:
+        return None
+    return result
+
+class StagingArea(object):
+    """Hand out directories in @path, a tmpfs, to targets whose
+    working set fits the @budget shared by all targets built at the
+    same time.
+
+    The working set is @factor times the image size of the previous
+    build, a target never built before goes to disk.
+    """
+
+    def __init__(self, path, budget, factor=3.0):
+        self.path = path
+        self.budget = budget
+        self.factor = factor
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def estimate(self, previous_size=None, working_set=None):
+        if working_set is not None:
+            return working_set
+        if not previous_size:
+            return None
+        return int(self.factor * previous_size)
+
+    def reserve(self, name, size):
+        """Return a staging directory for @name if @size bytes fit
+        in memory now, None otherwise."""
+        if size is None:
+            return None
+        ensure_dir(self.path)
+        with self._lock:
+            available = min(self.budget - self._reserved, free_space(self.path))
+            memory = mem_available()
+            if memory is not None:
+                available = min(available, memory)
+            if size > available:
+                logger.info("Building \"%s\" on disk, %s needed but %s available in memory" %
+                            (name, format_size(size), format_size(max(0, available))))
+                return None
+            self._reserved += size
+        logger.info("Building \"%s\" in %s with %s reserved" % (name, self.path, format_size(size)))
+        return tempfile.mkdtemp(prefix=name + "-", dir=self.path)
+
+    def release(self, path, size):
+        # Files were created with sudo
+        run_sync(["sudo", "rm", "-rf", path], fatal_on_error=False, log_success=False,
+                 log_initiation=False)
+        with self._lock:
+            self._reserved -= size
+
+def write_mic_config(staging_dir):
+    """Write a mic configuration assembling images in @staging_dir,
+    return its path."""
+    tmp_dir = os.path.join(staging_dir, "tmp")
+    ensure_dir(tmp_dir)
+    filename = os.path.join(staging_dir, "mic.conf")
+    with open(filename, "w") as f:
+        f.write("[create]\ntmpdir = /parentroot%s\n" % tmp_dir)
+    return filename
@@ -0,0 +1,144 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import stat
+import errno
+import shutil
+import tempfile
+
+from .logger import Logger
+from .fileutil import ensure_dir, file_linkcopy
+from .checksum import StreamDigest
+
+logger = Logger()
+
+BUFFER_SIZE = 1024 * 1024
+
+class ObjectStore(object):
+    """Content addressed store, published files are hard links to its objects.
+
+    The store must be on the same filesystem as the publish directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        ensure_dir(self.path)
+        self._dev = os.stat(self.path).st_dev
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def _hash(self, src, digest):
+        with open(src, "rb") as f:
+            while True:
+                data = f.read(BUFFER_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+
+    def _copy_and_hash(self, src, digest):
+        # Files from another filesystem are copied into the store once,
+        # hashing them while they are read
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, prefix=".tmp-")
+        with os.fdopen(fd, "wb") as dest_file:
+            with open(src, "rb") as src_file:
+                while True:
+                    data = src_file.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    digest.update(data)
+                    dest_file.write(data)
+        shutil.copystat(src, tmp_filename)
+        return tmp_filename
+
+    def _commit(self, filename, digest, move):
+        # Turn @filename into the object for @digest, @filename is either
+        # renamed or hard linked depending on @move
+        obj = self.object_path(digest)
+        ensure_dir(os.path.dirname(obj))
+        if os.path.exists(obj):
+            if move:
+                os.unlink(filename)
+            return obj
+        mode = os.stat(filename).st_mode
+        os.chmod(filename, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        try:
+            if move:
+                os.rename(filename, obj)
+            else:
+                os.link(filename, obj)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        return obj
+
+    def add(self, src, digest=None):
+        """Add @src to the store and return the path of its object.
+
+        @src is read only once, @digest is fed with its contents and
+        may compute more than the SHA-256 used to name the object.
+        """
+        if digest is None:
+            digest = StreamDigest()
+        if os.stat(src).st_dev == self._dev:
+            self._hash(src, digest)
+            return self._commit(src, digest.hexdigest("sha256"), False)
+        tmp_filename = self._copy_and_hash(src, digest)
+        return self._commit(tmp_filename, digest.hexdigest("sha256"), True)
+
+    def publish_tree(self, src, dest, zsync=False):
+        """Recreate @src in @dest with hard links to the store objects.
+
+        Each directory gets a SHA256SUMS file and, with @zsync, every
+        file gets a .zsync file for delta downloads.
+        """
+        for dirpath, dirnames, filenames in os.walk(src):
+            dest_dirpath = os.path.join(dest, os.path.relpath(dirpath, src))
+            ensure_dir(dest_dirpath)
+            sums = []
+            for name in dirnames + filenames:
+                src_path = os.path.join(dirpath, name)
+                dest_path = os.path.join(dest_dirpath, name)
+                if os.path.islink(src_path):
+                    os.symlink(os.readlink(src_path), dest_path)
+                elif name in filenames:
+                    src_stat = os.stat(src_path)
+                    digest = StreamDigest(zsync_length=src_stat.st_size if zsync else None)
+                    if not file_linkcopy(self.add(src_path, digest), dest_path):
+                        return False
+                    sums.append("%s  %s\n" % (digest.hexdigest("sha256"), name))
+                    if zsync:
+                        digest.write_zsync(dest_path + ".zsync", name, src_stat.st_mtime)
+            if sums:
+                with open(os.path.join(dest_dirpath, "SHA256SUMS"), "w") as f:
+                    f.write("".join(sorted(sums, key=lambda line: line[66:])))
+        return True
+
+    def prune(self):
+        """Remove objects that are not published anymore."""
+        removed = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.startswith(".tmp-") or os.lstat(path).st_nlink == 1:
+                    os.unlink(path)
+                    removed += 1
+        logger.info("Removed %d unreferenced objects from %s" % (removed, self.path))
+        return removed
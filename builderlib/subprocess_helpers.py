@@ -20,10 +20,23 @@
 # Boston, MA 02111-1307, USA.
 
 import os
+import re
 import sys
+import time
+import gzip
+import errno
+import binascii
+import fcntl
+import select
+import signal
+import threading
 import subprocess
+import collections
 
 from .logger import Logger
+from .trace import tracer
+
+logger = Logger()
 
 def _get_env_for_cwd(cwd=None, env=None):
     # This dance is necessary because we want to keep the PWD
@@ -42,10 +55,27 @@ def _get_env_for_cwd(cwd=None, env=None):
         env_copy = env
     return env_copy
 
+def _wait(proc, args, start_time, resources=None):
+    # Reap @proc with wait4() so that its resource usage is accounted
+    while True:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                return proc.wait()
+            raise
+    proc.returncode = _status_to_returncode(status)
+    tracer.record_process(args, proc.returncode, time.time() - start_time,
+                          _rusage_to_dict(rusage))
+    if resources is not None:
+        resources.add_rusage(_rusage_to_dict(rusage))
+    return proc.returncode
+
 def run_sync_get_output(args, cwd=None, env=None, stdout=None, stderr=None, none_on_error=False,
                         log_success=False, log_initiation=False):
-    logger = Logger()
-
     if log_initiation:
         logger.info("Running: %s" % (subprocess.list2cmdline(args),))
 
@@ -57,10 +87,13 @@ def run_sync_get_output(args, cwd=None, env=None, stdout=None, stderr=None, none
         stderr_target = sys.stderr
     else:
         stderr_target = stderr
+    start_time = time.time()
     proc = subprocess.Popen(args, stdin=f, stdout=subprocess.PIPE, stderr=stderr_target,
                             close_fds=True, cwd=cwd, env=env_copy)
     f.close()
-    output = proc.communicate()[0].strip()
+    output = proc.stdout.read().strip()
+    proc.stdout.close()
+    _wait(proc, args, start_time)
     if proc.returncode != 0 and not none_on_error:
         logfn = logger.fatal
     elif log_success:
@@ -76,8 +109,6 @@ def run_sync_get_output(args, cwd=None, env=None, stdout=None, stderr=None, none
 
 def run_sync_with_input_get_output(args, input, cwd=None, env=None, stderr=None,
                                    none_on_error=False, log_success=False, log_initiation=False):
-    logger = Logger()
-
     if log_initiation:
         logger.info("Running: %s" % (subprocess.list2cmdline(args),))
 
@@ -88,9 +119,26 @@ def run_sync_with_input_get_output(args, input, cwd=None, env=None, stderr=None,
     else:
         stderr_target = stderr
 
+    start_time = time.time()
     proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_target,
                             close_fds=True, cwd=cwd, env=env_copy)
-    output = proc.communicate(input=input)[0].strip()
+
+    # Feed input from another thread while reading the output,
+    # otherwise both sides may block on full pipes
+    def write_input():
+        try:
+            if input:
+                proc.stdin.write(input)
+        except (IOError, OSError):
+            pass
+        finally:
+            proc.stdin.close()
+    writer = threading.Thread(target=write_input)
+    writer.start()
+    output = proc.stdout.read().strip()
+    proc.stdout.close()
+    writer.join()
+    _wait(proc, args, start_time)
     if proc.returncode != 0 and not none_on_error:
         logfn = logger.fatal
     elif log_success:
@@ -105,9 +153,7 @@ def run_sync_with_input_get_output(args, input, cwd=None, env=None, stderr=None,
     return None
 
 def run_async(args, cwd=None, env=None, log_initiation=True, stdout=None,
-              stderr=None):
-    logger = Logger()
-
+              stderr=None, resources=None):
     if log_initiation:
         logger.info("Running: %s" % (subprocess.list2cmdline(args),))
 
@@ -123,6 +169,8 @@ def run_async(args, cwd=None, env=None, log_initiation=True, stdout=None,
     else:
         stderr_target = stderr
 
+    if resources is not None:
+        args = resources.wrap(args)
     proc = subprocess.Popen(args, stdin=subprocess.PIPE,
                             stdout=stdout_target, stderr=stderr_target,
                             close_fds=True, cwd=cwd, env=env_copy)
@@ -130,8 +178,11 @@ def run_async(args, cwd=None, env=None, log_initiation=True, stdout=None,
 
 def run_sync(args, cwd=None, env=None, fatal_on_error=True, keep_stdin=False,
              log_success=True, log_initiation=True, stdin=None, stdout=None,
-             stderr=None, return_exitcode=False):
-    logger = Logger()
+             stderr=None, return_exitcode=False, capture=None, resources=None):
+    # @resources is a ResourceProfile applied to the whole process tree
+    if capture is not None:
+        return _run_sync_captured(args, cwd, env, fatal_on_error, log_success,
+                                  log_initiation, return_exitcode, capture, resources)
 
     if log_initiation:
         logger.info("Running: %s" % (subprocess.list2cmdline(args),))
@@ -155,11 +206,13 @@ def run_sync(args, cwd=None, env=None, fatal_on_error=True, keep_stdin=False,
     else:
         stderr_target = stderr
 
-    proc = subprocess.Popen(args, stdin=stdin_target, stdout=stdout_target, stderr=stderr_target,
+    start_time = time.time()
+    launch_args = resources.wrap(args) if resources is not None else args
+    proc = subprocess.Popen(launch_args, stdin=stdin_target, stdout=stdout_target, stderr=stderr_target,
                             close_fds=True, cwd=cwd, env=env_copy)
     if not keep_stdin:
         stdin_target.close()
-    returncode = proc.wait()
+    returncode = _wait(proc, args, start_time, resources)
     if fatal_on_error and returncode != 0:
         logfn = logger.fatal
     elif log_success:
@@ -175,3 +228,481 @@ def run_sync(args, cwd=None, env=None, fatal_on_error=True, keep_stdin=False,
     if return_exitcode:
         return (success, returncode)
     return success
+
+def _rusage_to_dict(rusage):
+    return {"utime": rusage.ru_utime, "stime": rusage.ru_stime,
+            "maxrss": rusage.ru_maxrss, "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock}
+
+def _status_to_returncode(status):
+    # Same convention as subprocess: negative values are signals
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class ProcessResult(object):
+    def __init__(self, args):
+        self.args = args
+        self.pid = None
+        self.returncode = None
+        self.timed_out = False
+        self.cancelled = False
+        self.wall_time = 0.0
+        self.rusage = None
+
+    @property
+    def success(self):
+        return self.returncode == 0
+
+# Progress bars redraw the line with a carriage return
+_line_break_re = re.compile(b"\r\n|\r|\n")
+
+def _split_lines(data, final=False, max_line=None):
+    # Split @data into complete lines and what is left of the line
+    # still being written, lines longer than @max_line are cut
+    held = b""
+    # A trailing carriage return may be the start of a CRLF
+    if not final and data.endswith(b"\r"):
+        data, held = data[:-1], b"\r"
+    lines = _line_break_re.split(data)
+    partial = b"" if final else lines.pop()
+    if max_line is None:
+        return lines, partial + held
+    pieces = []
+    for line in lines:
+        while len(line) > max_line:
+            pieces.append(line[:max_line])
+            line = line[max_line:]
+        pieces.append(line)
+    while len(partial) >= max_line:
+        pieces.append(partial[:max_line])
+        partial = partial[max_line:]
+    return pieces, partial + held
+
+class _Process(object):
+    def __init__(self, args, cwd, env, timeout, stdout_cb, stderr_cb, resources=None):
+        self.args = args
+        self.resources = resources
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.callbacks = {}
+        self.callbacks["stdout"] = stdout_cb
+        self.callbacks["stderr"] = stderr_cb
+        self.result = ProcessResult(args)
+        self.proc = None
+        self.start_time = None
+        self.deadline = None
+        self.buffers = {}
+        self.fds = {}
+        self.kill_time = None
+        self.cancel_requested = False
+
+class ProcessRunner(object):
+    """Run many commands at the same time from a single thread.
+
+    Output is read line by line with poll() and handed to callbacks,
+    each command may have a timeout and can be cancelled; the whole
+    process group is killed in both cases.  Results carry the exit
+    status and the resource usage reported by wait4().
+    """
+
+    KILL_GRACE = 5.0
+
+    # Longer lines are passed on in pieces, so that output without
+    # line breaks doesn't pile up in memory
+    MAX_LINE = 65536
+
+    def __init__(self, max_jobs=None, log_initiation=True):
+        self.max_jobs = max_jobs
+        self.log_initiation = log_initiation
+        self._logger = logger
+        self._processes = []
+        self._wakeup = os.pipe()
+        for fd in self._wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def add(self, args, cwd=None, env=None, timeout=None, stdout_cb=None, stderr_cb=None,
+            resources=None):
+        """Queue @args, @stdout_cb and @stderr_cb receive each output line.
+        @resources is a ResourceProfile applied to the command."""
+        process = _Process(args, cwd, env, timeout, stdout_cb, stderr_cb, resources)
+        self._processes.append(process)
+        return process
+
+    def cancel(self, process):
+        """Kill @process, can be called from callbacks or other threads."""
+        process.cancel_requested = True
+        try:
+            os.write(self._wakeup[1], b"x")
+        except OSError:
+            pass
+
+    def _start(self, process, poller):
+        if self.log_initiation:
+            self._logger.info("Running: %s" % (subprocess.list2cmdline(process.args),))
+        env_copy = _get_env_for_cwd(process.cwd, process.env)
+        stdin = open('/dev/null', 'r')
+        args = process.args
+        if process.resources is not None:
+            args = process.resources.wrap(args)
+        process.proc = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, close_fds=True,
+                                        cwd=process.cwd, env=env_copy, preexec_fn=os.setsid)
+        stdin.close()
+        process.result.pid = process.proc.pid
+        process.start_time = time.time()
+        if process.timeout is not None:
+            process.deadline = process.start_time + process.timeout
+        for name, stream in (("stdout", process.proc.stdout), ("stderr", process.proc.stderr)):
+            fd = stream.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            process.fds[fd] = name
+            process.buffers[name] = b""
+            poller.register(fd, select.POLLIN | select.POLLHUP | select.POLLERR)
+
+    def _emit(self, process, name, data, final=False):
+        lines, process.buffers[name] = _split_lines(process.buffers[name] + data, final, self.MAX_LINE)
+        callback = process.callbacks[name]
+        for line in lines:
+            if final and not line:
+                continue
+            if callback is not None:
+                callback(line.decode("utf-8", "replace"))
+
+    def _read(self, process, fd, poller):
+        name = process.fds[fd]
+        try:
+            data = os.read(fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            data = b""
+        if data:
+            self._emit(process, name, data)
+        else:
+            self._emit(process, name, b"", final=True)
+            poller.unregister(fd)
+            del process.fds[fd]
+            getattr(process.proc, name).close()
+
+    def _kill(self, process, sig):
+        try:
+            os.killpg(process.proc.pid, sig)
+        except OSError:
+            pass
+
+    def _reap(self, process):
+        try:
+            pid, status, rusage = os.wait4(process.proc.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            return True
+        if pid == 0:
+            return False
+        process.proc.returncode = _status_to_returncode(status)
+        process.result.returncode = process.proc.returncode
+        process.result.rusage = _rusage_to_dict(rusage)
+        process.result.wall_time = time.time() - process.start_time
+        tracer.record_process(process.args, process.result.returncode,
+                              process.result.wall_time, process.result.rusage)
+        if process.resources is not None:
+            process.resources.add_rusage(process.result.rusage)
+        return True
+
+    def run(self):
+        """Run all queued commands and return their results in order."""
+        poller = select.poll()
+        poller.register(self._wakeup[0], select.POLLIN)
+        pending = list(self._processes)
+        running = []
+        fd_map = {}
+
+        while pending or running:
+            # Start as many commands as allowed
+            while pending and (self.max_jobs is None or len(running) < self.max_jobs):
+                process = pending.pop(0)
+                if process.cancel_requested:
+                    process.result.cancelled = True
+                    continue
+                self._start(process, poller)
+                for fd in process.fds:
+                    fd_map[fd] = process
+                running.append(process)
+            # Commands left may all have been cancelled before starting
+            if not running:
+                break
+
+            # Compute how long we can wait
+            now = time.time()
+            timeout = None
+            for process in running:
+                for deadline in (process.deadline, process.kill_time):
+                    if deadline is not None:
+                        remaining = max(0.0, deadline - now)
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                if not process.fds:
+                    # Output is closed but the process didn't exit yet
+                    timeout = 0.05 if timeout is None else min(timeout, 0.05)
+
+            try:
+                events = poller.poll(None if timeout is None else int(timeout * 1000) + 1)
+            except (select.error, OSError) as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                events = []
+            for fd, event in events:
+                if fd == self._wakeup[0]:
+                    try:
+                        os.read(fd, 4096)
+                    except OSError:
+                        pass
+                elif fd in fd_map:
+                    process = fd_map[fd]
+                    self._read(process, fd, poller)
+                    if fd not in process.fds:
+                        del fd_map[fd]
+
+            # Timeouts, cancellation and termination
+            now = time.time()
+            for process in list(running):
+                if process.kill_time is None:
+                    if process.cancel_requested:
+                        process.result.cancelled = True
+                    elif process.deadline is not None and now >= process.deadline:
+                        process.result.timed_out = True
+                        self._logger.error("cmd '%s' timed out after %s seconds" %
+                                           (subprocess.list2cmdline(process.args), process.timeout))
+                    if process.result.cancelled or process.result.timed_out:
+                        self._kill(process, signal.SIGTERM)
+                        process.kill_time = now + self.KILL_GRACE
+                elif now >= process.kill_time:
+                    self._kill(process, signal.SIGKILL)
+                    process.kill_time = now + self.KILL_GRACE
+
+                if not process.fds and self._reap(process):
+                    running.remove(process)
+
+        poller.unregister(self._wakeup[0])
+        return [process.result for process in self._processes]
+
+    def close(self):
+        for fd in self._wakeup:
+            os.close(fd)
+
+def run_many(commands, max_jobs=None, log_initiation=True):
+    """Run @commands, a list of argument lists, concurrently and return their results."""
+    runner = ProcessRunner(max_jobs, log_initiation)
+    for args in commands:
+        runner.add(args)
+    try:
+        return runner.run()
+    finally:
+        runner.close()
+
+class ChrootSession(object):
+    """Enter the SDK chroot once and run commands through a shell
+    reading them from a pipe, saving the mount and namespace setup
+    of entering it for each command.
+
+    Each command runs in a subshell with stdin from /dev/null and its
+    output merged, followed by a marker line with its exit status.
+    """
+
+    CLOSE_TIMEOUT = 10
+    MAX_LINE = ProcessRunner.MAX_LINE
+
+    def __init__(self, sdk_cmd):
+        self.sdk_cmd = sdk_cmd
+        self._marker = "--mauibuild-%s--" % binascii.hexlify(os.urandom(8)).decode("ascii")
+        self._proc = run_async([sdk_cmd, "sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._lines = collections.deque()
+        self._partial = b""
+        self._eof = False
+
+    def alive(self):
+        return self._proc is not None and not self._eof and self._proc.poll() is None
+
+    def _readline(self):
+        # Next line of output or None once the shell is gone, lines are
+        # split and cut the same way as with ProcessRunner
+        while not self._lines:
+            try:
+                data = os.read(self._proc.stdout.fileno(), 65536)
+            except OSError:
+                data = b""
+            if not data:
+                self._eof = True
+                return None
+            lines, self._partial = _split_lines(self._partial + data, max_line=self.MAX_LINE)
+            self._lines.extend(lines)
+        return self._lines.popleft().decode("utf-8", "replace")
+
+    def run(self, args, output_cb=None):
+        """Run @args, the words that would follow the chroot command,
+        and return the exit status or None if the session died."""
+        line = "( %s ) </dev/null 2>&1; printf '\\n%s %%d\\n' $?\n" % (" ".join(args), self._marker)
+        try:
+            self._proc.stdin.write(line.encode("utf-8"))
+            self._proc.stdin.flush()
+        except (IOError, OSError):
+            return None
+        pending = None
+        while True:
+            text = self._readline()
+            if text is None:
+                # The session died, the last line is still output
+                if pending is not None and output_cb is not None:
+                    output_cb(pending)
+                return None
+            if text.startswith(self._marker + " "):
+                # The marker follows a newline that isn't part of the output
+                if pending and output_cb is not None:
+                    output_cb(pending)
+                return int(text.split()[1])
+            if pending is not None and output_cb is not None:
+                output_cb(pending)
+            pending = text
+
+    def close(self):
+        # Let the shell leave the chroot, which undoes its setup,
+        # killing it if it doesn't in a reasonable time
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        deadline = time.time() + self.CLOSE_TIMEOUT
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() is None:
+            logger.warning("SDK chroot session pid %d didn't exit, killing it" % proc.pid)
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+class ChrootSessionPool(object):
+    """Run commands in the SDK chroot, reusing up to @max_sessions
+    sessions so that commands can still run concurrently."""
+
+    def __init__(self, sdk_cmd, max_sessions=1):
+        self.sdk_cmd = sdk_cmd
+        self.max_sessions = max(1, max_sessions)
+        self._idle = []
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._count >= self.max_sessions:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return ChrootSession(self.sdk_cmd)
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, session):
+        with self._cond:
+            if session is not None and session.alive():
+                self._idle.append(session)
+            else:
+                self._count -= 1
+            self._cond.notify()
+
+    def run_sync(self, args, fatal_on_error=True, log_initiation=True, capture=None):
+        """Same as run_sync() with [sdk_cmd] + @args, output goes to
+        @capture or to stdout."""
+        if log_initiation:
+            logger.info("Running in SDK session: %s" % " ".join(args))
+        if capture is not None:
+            output_cb = capture.write_line
+        else:
+            def output_cb(line):
+                sys.stdout.write(line + "\n")
+        session = self._acquire()
+        try:
+            returncode = session.run(args, output_cb)
+        except BaseException:
+            session.close()
+            raise
+        finally:
+            if not session.alive():
+                session.close()
+            self._release(session)
+
+        if returncode is None:
+            logger.error("SDK chroot session exited while running: %s" % " ".join(args))
+            returncode = -1
+        if returncode != 0:
+            if capture is not None:
+                logger.error("Last lines of output, see %s for more:\n%s" %
+                             (capture.filename, "\n".join(capture.tail)))
+            if fatal_on_error:
+                logger.fatal("Command %s exited with code %d" % (" ".join(args), returncode))
+        return returncode == 0
+
+    def close(self):
+        with self._cond:
+            sessions, self._idle = self._idle, []
+            self._count -= len(sessions)
+        for session in sessions:
+            session.close()
+
+class OutputCapture(object):
+    """Write output of commands to a log file, optionally compressed,
+    keeping only the last @tail lines in memory for error reports."""
+
+    def __init__(self, filename, tail=50, compress=False):
+        if compress and not filename.endswith(".gz"):
+            filename += ".gz"
+        self.filename = filename
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        if compress:
+            self._file = gzip.open(filename, "ab")
+        else:
+            self._file = open(filename, "ab")
+        self.tail = collections.deque(maxlen=tail)
+
+    def write_line(self, line):
+        self.tail.append(line)
+        self._file.write((line + "\n").encode("utf-8"))
+
+    def write_stderr_line(self, line):
+        self.write_line("stderr: " + line)
+
+    def close(self):
+        self._file.close()
+
+def _run_sync_captured(args, cwd, env, fatal_on_error, log_success, log_initiation,
+                       return_exitcode, capture, resources=None):
+    # Stream output into @capture instead of the terminal
+    runner = ProcessRunner(log_initiation=log_initiation)
+    runner.add(args, cwd=cwd, env=env, stdout_cb=capture.write_line,
+               stderr_cb=capture.write_stderr_line, resources=resources)
+    try:
+        result = runner.run()[0]
+    finally:
+        runner.close()
+
+    if fatal_on_error and result.returncode != 0:
+        logger.error("Last lines of output, see %s for more:\n%s" %
+                     (capture.filename, "\n".join(capture.tail)))
+        logfn = logger.fatal
+    elif log_success:
+        logfn = logger.debug
+    else:
+        logfn = None
+    if logfn is not None:
+        logfn("pid %d exited with code %d" % (result.pid, result.returncode))
+    success = result.returncode == 0
+    if return_exitcode:
+        return (success, result.returncode)
+    return success
@@ -0,0 +1,133 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+from .logger import Logger
+from .fileutil import atomic_write_json
+
+logger = Logger()
+
+# rusage block counts are in 512 bytes units
+BLOCK_SIZE = 512
+
+class Tracer(object):
+    """Collect timing spans and child process accounting for a run.
+
+    Events can be saved in the Chrome trace format, to be loaded into
+    chrome://tracing, and summarized in a table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._processes = []
+        self._origin = time.time()
+
+    def reset(self):
+        with self._lock:
+            self._events = []
+            self._processes = []
+            self._origin = time.time()
+
+    def _add(self, name, category, start, end, args):
+        event = {"name": name, "cat": category, "ph": "X",
+                 "ts": int((start - self._origin) * 1000000),
+                 "dur": int((end - start) * 1000000),
+                 "pid": os.getpid(), "tid": threading.current_thread().ident,
+                 "args": args}
+        with self._lock:
+            self._events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add(name, "phase", start, time.time(), args)
+
+    def record_process(self, args, returncode, wall_time, rusage):
+        """Account a child process that ran for @wall_time seconds."""
+        if rusage is None:
+            return
+        end = time.time()
+        name = os.path.basename(args[0])
+        info = {"cmd": " ".join(args), "returncode": returncode,
+                "utime": rusage["utime"], "stime": rusage["stime"],
+                "maxrss_kb": rusage["maxrss"],
+                "read_bytes": rusage["inblock"] * BLOCK_SIZE,
+                "write_bytes": rusage["oublock"] * BLOCK_SIZE}
+        self._add(name, "process", end - wall_time, end, info)
+        entry = dict(info, name=name, wall=wall_time)
+        with self._lock:
+            self._processes.append(entry)
+
+    def save(self, filename):
+        with self._lock:
+            data = {"traceEvents": list(self._events), "displayTimeUnit": "ms"}
+        atomic_write_json(filename, data)
+
+    def summary(self):
+        """Return a table with the time spent in each phase and command."""
+        with self._lock:
+            events = list(self._events)
+            processes = list(self._processes)
+
+        lines = ["%-32s %6s %10s" % ("Phase", "Count", "Wall (s)")]
+        phases = {}
+        for event in events:
+            if event["cat"] == "phase":
+                entry = phases.setdefault(event["name"], [0, 0.0])
+                entry[0] += 1
+                entry[1] += event["dur"] / 1000000.0
+        for name, (count, wall) in sorted(phases.items(), key=lambda item: -item[1][1]):
+            lines.append("%-32s %6d %10.2f" % (name[:32], count, wall))
+
+        lines.append("")
+        lines.append("%-20s %6s %10s %10s %12s %10s %10s" %
+                     ("Command", "Count", "Wall (s)", "CPU (s)", "Max RSS (MB)", "Read (MB)", "Write (MB)"))
+        commands = {}
+        for info in processes:
+            entry = commands.setdefault(info["name"], [0, 0.0, 0.0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += info["wall"]
+            entry[2] += info["utime"] + info["stime"]
+            entry[3] = max(entry[3], info["maxrss_kb"])
+            entry[4] += info["read_bytes"]
+            entry[5] += info["write_bytes"]
+        for name, entry in sorted(commands.items(), key=lambda item: -item[1][1]):
+            lines.append("%-20s %6d %10.2f %10.2f %12.1f %10.1f %10.1f" %
+                         (name[:20], entry[0], entry[1], entry[2], entry[3] / 1024.0,
+                          entry[4] / 1048576.0, entry[5] / 1048576.0))
+        return "\n".join(lines)
+
+    def report(self, filename=None):
+        if filename is not None:
+            self.save(filename)
+            logger.info("Trace saved to %s" % filename)
+        logger.info("Build summary:\n%s" % self.summary())
+
+# Shared by the whole process
+tracer = Tracer()
+span = tracer.span
@@ -0,0 +1,412 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+# Build targets on other hosts.
+#
+# Workers listen on a TCP port and speak a line based JSON protocol,
+# each request uses its own connection and carries the shared secret:
+#
+#   {"type": "ping", "secret": ...}  ->  {"type": "pong", "busy": false}
+#   {"type": "build", "secret": ..., "name": ..., "cache": ..., "kickstart": ...}
+#       ->  {"type": "progress"} every HEARTBEAT_INTERVAL seconds, then
+#           {"type": "result", "success": true, "files": [{"path": ..., "size": ..., "mode": ...}]}
+#           followed by the contents of each file
+#
+# The secret is sent in clear text, use an SSH tunnel to reach workers
+# over untrusted networks.
+
+import os
+import json
+import time
+import hmac
+import shutil
+import socket
+import tempfile
+import threading
+import multiprocessing
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    string_types = basestring
+    integer_types = (int, long)
+except NameError:
+    string_types = str
+    integer_types = (int,)
+
+from .logger import Logger
+from .fileutil import ensure_dir
+from .subprocess_helpers import run_sync, OutputCapture
+
+logger = Logger()
+
+BUFFER_SIZE = 1024 * 1024
+
+# Received blocks of zeroes are skipped, keeping images sparse
+SPARSE_BLOCK = 4096
+_ZERO_BLOCK = b"\0" * SPARSE_BLOCK
+
+# A worker that stays silent for HEARTBEAT_TIMEOUT seconds is dead
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_TIMEOUT = 4 * HEARTBEAT_INTERVAL
+
+class WorkerError(Exception):
+    """The worker went away, the job can be sent to another one."""
+
+class BuildError(Exception):
+    """The build itself failed."""
+
+def _send(wfile, message):
+    wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+    wfile.flush()
+
+def _receive(rfile):
+    line = rfile.readline()
+    if not line:
+        raise WorkerError("Connection closed")
+    return json.loads(line.decode("utf-8"))
+
+def _valid_name(name):
+    # Names end up in paths on the worker
+    return isinstance(name, string_types) and name not in ("", ".") and "/" not in name and ".." not in name
+
+def _destination(dest, entry):
+    # Files are named by the worker, only relative paths staying in
+    # @dest are accepted
+    path = entry.get("path") if isinstance(entry, dict) else None
+    if not isinstance(path, string_types) or not path or os.path.isabs(path) or \
+            ".." in path.split("/"):
+        return None
+    filename = os.path.normpath(os.path.join(dest, path))
+    if not filename.startswith(os.path.normpath(dest) + os.sep):
+        return None
+    return filename
+
+def _write_sparse(f, data):
+    # Seek over blocks of zeroes instead of writing them
+    for offset in range(0, len(data), SPARSE_BLOCK):
+        block = data[offset:offset + SPARSE_BLOCK]
+        if block == _ZERO_BLOCK[:len(block)]:
+            f.seek(len(block), os.SEEK_CUR)
+        else:
+            f.write(block)
+
+def _list_files(path):
+    result = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            filename = os.path.join(dirpath, filename)
+            if not os.path.islink(filename):
+                st = os.stat(filename)
+                result.append({"path": os.path.relpath(filename, path),
+                               "size": st.st_size, "mode": st.st_mode & 0o777})
+    return result
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        worker = self.server.worker
+        try:
+            request = _receive(self.rfile)
+        except (WorkerError, ValueError):
+            return
+        if not worker.authorized(request):
+            logger.warning("Rejected request from %s: wrong secret" % self.client_address[0])
+            _send(self.wfile, {"type": "error", "error": "Wrong secret"})
+            return
+        if request.get("type") == "ping":
+            _send(self.wfile, {"type": "pong", "busy": worker.busy})
+        elif request.get("type") == "build":
+            if not _valid_name(request.get("name")) or not _valid_name(request.get("cache")):
+                _send(self.wfile, {"type": "error", "error": "Invalid target name or cache"})
+                return
+            worker.build(request, self.wfile)
+
+class _WorkerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Worker(object):
+    """Build targets sent by a coordinator knowing @secret, one at a
+    time."""
+
+    def __init__(self, sdk_cmd, work_dir, secret):
+        self.sdk_cmd = sdk_cmd
+        self.work_dir = work_dir
+        self.secret = secret
+        self.busy = False
+        self._lock = threading.Lock()
+
+    def authorized(self, request):
+        secret = request.get("secret")
+        if not isinstance(secret, string_types):
+            return False
+        return hmac.compare_digest(secret.encode("utf-8"), self.secret.encode("utf-8"))
+
+    def build(self, request, wfile):
+        with self._lock:
+            self.busy = True
+            try:
+                self._build(request, wfile)
+            finally:
+                self.busy = False
+
+    def _build(self, request, wfile):
+        name = request["name"]
+        ensure_dir(self.work_dir)
+        job_dir = tempfile.mkdtemp(prefix="job-", dir=self.work_dir)
+        try:
+            with open(os.path.join(job_dir, name + ".ks"), "w") as f:
+                f.write(request["kickstart"])
+            cache_dir = os.path.join(self.work_dir, "cache", request["cache"])
+            ensure_dir(os.path.dirname(cache_dir))
+
+            cmd = [self.sdk_cmd, "cd", "/parentroot" + job_dir, ";",
+                   "sudo", "mic", "create", "auto", name + ".ks",
+                   "-k", "/parentroot" + cache_dir]
+            capture = OutputCapture(os.path.join(self.work_dir, "logs", name + ".log"))
+            # Let the coordinator know we're still alive during long builds
+            done = threading.Event()
+            def heartbeat():
+                while not done.wait(HEARTBEAT_INTERVAL):
+                    try:
+                        _send(wfile, {"type": "progress"})
+                    except (socket.error, IOError):
+                        return
+            thread = threading.Thread(target=heartbeat)
+            thread.daemon = True
+            thread.start()
+            try:
+                success = run_sync(cmd, capture=capture, fatal_on_error=False)
+            finally:
+                done.set()
+                thread.join()
+                capture.close()
+
+            path = os.path.join(job_dir, name)
+            if success and os.path.isdir(path):
+                s = "%d:%d" % (os.getuid(), os.getgid())
+                run_sync(["sudo", "chown", "-R", s, path], fatal_on_error=False)
+                files = _list_files(path)
+            else:
+                success = False
+                files = []
+
+            # Send the image back
+            _send(wfile, {"type": "result", "success": success, "files": files,
+                          "log": list(capture.tail)})
+            for entry in files:
+                with open(os.path.join(path, entry["path"]), "rb") as f:
+                    shutil.copyfileobj(f, wfile, BUFFER_SIZE)
+            wfile.flush()
+        finally:
+            run_sync(["sudo", "rm", "-rf", job_dir], fatal_on_error=False, log_success=False,
+                     log_initiation=False)
+
+def serve(address, sdk_cmd, work_dir, secret):
+    """Run a worker listening on @address, a (host, port) tuple."""
+    server = _WorkerServer(address, _WorkerHandler)
+    server.worker = Worker(sdk_cmd, work_dir, secret)
+    logger.info("Worker listening on %s:%d" % server.server_address)
+    server.serve_forever()
+
+def _serve_local(address, sdk_cmd, work_dir, secret, ready):
+    server = _WorkerServer(address, _WorkerHandler)
+    server.worker = Worker(sdk_cmd, work_dir, secret)
+    ready.put(server.server_address)
+    server.serve_forever()
+
+def start_local_workers(count, sdk_cmd, work_dir, secret):
+    """Start @count workers in other processes on this host, returns
+    the processes and their addresses."""
+    ready = multiprocessing.Queue()
+    processes = []
+    addresses = []
+    for i in range(count):
+        process = multiprocessing.Process(target=_serve_local,
+                                          args=(("127.0.0.1", 0), sdk_cmd,
+                                                os.path.join(work_dir, "worker-%d" % i), secret, ready))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        host, port = ready.get(timeout=30)
+        addresses.append("%s:%d" % (host, port))
+    return processes, addresses
+
+def parse_address(address, default_host="127.0.0.1"):
+    # Either HOST:PORT or only the port
+    if ":" not in address:
+        return (default_host, int(address))
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+class RemoteWorker(object):
+    def __init__(self, address, secret, caches=None):
+        self.address = address
+        self.secret = secret
+        self.caches = caches
+        self.alive = True
+        self.busy = False
+
+    def accepts(self, target):
+        # Workers may only have the packages caches of some architectures
+        return self.caches is None or target["cache"] in self.caches
+
+    def _connect(self, timeout):
+        try:
+            sock = socket.create_connection(parse_address(self.address), timeout)
+        except (socket.error, IOError) as e:
+            raise WorkerError("Unable to connect to %s: %s" % (self.address, e))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return sock
+
+    def ping(self, timeout=10):
+        sock = None
+        try:
+            sock = self._connect(timeout)
+            rfile = sock.makefile("rb")
+            wfile = sock.makefile("wb")
+            _send(wfile, {"type": "ping", "secret": self.secret})
+            reply = _receive(rfile)
+            if reply.get("type") == "error":
+                logger.error("Worker %s: %s" % (self.address, reply.get("error")))
+            return reply.get("type") == "pong"
+        except (WorkerError, socket.error, IOError, ValueError):
+            return False
+        finally:
+            if sock is not None:
+                sock.close()
+
+    def build(self, target, kickstart, dest):
+        sock = self._connect(30)
+        # Workers send progress messages while building, a silent one
+        # went away without closing the connection
+        sock.settimeout(HEARTBEAT_TIMEOUT)
+        try:
+            rfile = sock.makefile("rb")
+            wfile = sock.makefile("wb")
+            _send(wfile, {"type": "build", "secret": self.secret, "name": target["name"],
+                          "cache": target["cache"], "kickstart": kickstart})
+            reply = _receive(rfile)
+            while reply.get("type") == "progress":
+                reply = _receive(rfile)
+            if reply.get("type") == "error":
+                raise BuildError("Worker %s refused to build \"%s\": %s" %
+                                 (self.address, target["name"], reply.get("error")))
+            if not reply.get("success"):
+                raise BuildError("Build of \"%s\" failed on %s:\n%s" %
+                                 (target["name"], self.address, "\n".join(reply.get("log", []))))
+
+            # Receive the image
+            for entry in reply["files"]:
+                filename = _destination(dest, entry)
+                if filename is None or not isinstance(entry.get("size"), integer_types) or \
+                        entry["size"] < 0 or not isinstance(entry.get("mode"), integer_types):
+                    raise WorkerError("Worker %s sent an invalid file entry %s" %
+                                      (self.address, json.dumps(entry)))
+                ensure_dir(os.path.dirname(filename))
+                remaining = entry["size"]
+                with open(filename, "wb") as f:
+                    while remaining > 0:
+                        data = rfile.read(min(BUFFER_SIZE, remaining))
+                        if not data:
+                            raise WorkerError("Connection to %s closed during transfer" % self.address)
+                        _write_sparse(f, data)
+                        remaining -= len(data)
+                    # Trailing zeroes were skipped
+                    f.truncate(entry["size"])
+                os.chmod(filename, entry["mode"] & 0o777)
+        except (socket.error, IOError, ValueError) as e:
+            raise WorkerError("Lost connection to %s: %s" % (self.address, e))
+        finally:
+            sock.close()
+
+class WorkerPool(object):
+    """Dispatch builds to the first idle and healthy worker.
+
+    A job whose worker dies is queued again for another worker, dead
+    workers are checked again every @retry_interval seconds.
+    """
+
+    def __init__(self, hosts, secret, retry_interval=60, attempts=3):
+        # Each host is either an address or a dictionary with the
+        # address and the packages caches it can build for
+        self.workers = []
+        for host in hosts:
+            if isinstance(host, dict):
+                self.workers.append(RemoteWorker(host["address"], secret, host.get("caches")))
+            else:
+                self.workers.append(RemoteWorker(host, secret))
+        self.retry_interval = retry_interval
+        self.attempts = attempts
+        self._cond = threading.Condition()
+        self._last_check = 0
+
+    def check(self):
+        """Ping workers and update their health."""
+        for worker in self.workers:
+            alive = worker.ping()
+            if alive != worker.alive:
+                logger.info("Worker %s is %s" % (worker.address, "back" if alive else "dead"))
+            worker.alive = alive
+        self._last_check = time.time()
+
+    def _acquire(self, target):
+        with self._cond:
+            while True:
+                if time.time() - self._last_check > self.retry_interval:
+                    self.check()
+                alive = [worker for worker in self.workers if worker.alive and worker.accepts(target)]
+                if not alive:
+                    raise WorkerError("No worker available for \"%s\"" % target["name"])
+                for worker in alive:
+                    if not worker.busy:
+                        worker.busy = True
+                        return worker
+                self._cond.wait(self.retry_interval)
+
+    def _release(self, worker, alive=True):
+        with self._cond:
+            worker.busy = False
+            worker.alive = alive
+            self._cond.notify_all()
+
+    def build(self, target, kickstart_filename, dest):
+        """Build @target on a worker and store the image in @dest."""
+        with open(kickstart_filename, "r") as f:
+            kickstart = f.read()
+        for attempt in range(self.attempts):
+            worker = self._acquire(target)
+            logger.info("Building \"%s\" on %s" % (target["name"], worker.address))
+            try:
+                worker.build(target, kickstart, dest)
+            except WorkerError as e:
+                logger.warning("%s, queueing \"%s\" again" % (e, target["name"]))
+                self._release(worker, alive=False)
+                if os.path.isdir(dest):
+                    shutil.rmtree(dest)
+                continue
+            except BaseException:
+                self._release(worker)
+                raise
+            self._release(worker)
+            return
+        raise WorkerError("Unable to build \"%s\" after %d attempts" % (target["name"], self.attempts))
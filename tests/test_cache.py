@@ -0,0 +1,92 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builderlib import cache
+from builderlib.cache import PackageCache
+
+class LocalPackageCache(PackageCache):
+    # The test owns the caches, sudo isn't needed
+    def _run(self, args, input):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+        proc.communicate(input.encode("utf-8"))
+
+class PackageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.hashed = []
+        self._hash_file = cache.hash_file
+        def hash_file(hasher, path):
+            self.hashed.append(path)
+            return self._hash_file(hasher, path)
+        cache.hash_file = hash_file
+
+    def tearDown(self):
+        cache.hash_file = self._hash_file
+        shutil.rmtree(self.tmp_dir)
+
+    def package(self, cache_name, name, data):
+        path = os.path.join(self.tmp_dir, cache_name, "packages", "main", name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_deduplicate(self):
+        package_cache = LocalPackageCache(self.tmp_dir)
+        a = self.package("x86", "foo.rpm", b"foo")
+        b = self.package("x86_64", "foo.rpm", b"foo")
+        c = self.package("armv7hl", "foo.rpm", b"bar")
+        self.assertEqual(package_cache.deduplicate(package_cache._scan()), 3)
+        self.assertTrue(os.path.samefile(a, b))
+        self.assertFalse(os.path.samefile(a, c))
+
+        # Packages already linked together are not read again
+        del self.hashed[:]
+        self.assertEqual(package_cache.deduplicate(package_cache._scan()), 0)
+        self.assertEqual(len(self.hashed), 2)
+
+        os.unlink(c)
+        del self.hashed[:]
+        self.assertEqual(package_cache.deduplicate(package_cache._scan()), 0)
+        self.assertEqual(self.hashed, [])
+
+    def test_link_group(self):
+        # A new copy is linked to every path of an existing group
+        package_cache = LocalPackageCache(self.tmp_dir)
+        a = self.package("x86", "foo.rpm", b"foo")
+        b = os.path.join(self.tmp_dir, "x86_64", "packages", "main", "foo.rpm")
+        os.makedirs(os.path.dirname(b))
+        os.link(a, b)
+        c = self.package("armv7hl", "foo.rpm", b"foo")
+        self.assertEqual(package_cache.deduplicate(package_cache._scan()), 3)
+        self.assertTrue(os.path.samefile(a, b))
+        self.assertTrue(os.path.samefile(b, c))
+
+if __name__ == "__main__":
+    unittest.main()
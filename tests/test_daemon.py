@@ -0,0 +1,158 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builderlib.daemon import BuildDaemon, send_command
+
+def git(args, cwd):
+    subprocess.check_call(["git", "-c", "user.name=Test", "-c", "user.email=test@localhost"] + args,
+                          cwd=cwd, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+
+class BuildDaemonTest(unittest.TestCase):
+    def setUp(self):
+        # Upstream is a bare repository, changes are pushed from a clone
+        self.tmp_dir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.tmp_dir, "upstream.git")
+        self.checkout = os.path.join(self.tmp_dir, "checkout")
+        git(["init", "-q", "--bare", self.upstream], self.tmp_dir)
+        git(["clone", "-q", self.upstream, self.checkout], self.tmp_dir)
+        self.commit()
+        self.builds = []
+        self.fail = False
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def commit(self):
+        with open(os.path.join(self.checkout, "maui.yaml"), "a") as f:
+            f.write("change\n")
+        git(["add", "maui.yaml"], self.checkout)
+        git(["commit", "-q", "-m", "Change"], self.checkout)
+        git(["push", "-q", "origin", "HEAD:master"], self.checkout)
+
+    def check(self):
+        output = subprocess.check_output(["git", "ls-remote", self.upstream, "refs/heads/master"])
+        return output.decode("utf-8").split()[0]
+
+    def build(self):
+        self.builds.append(self.check())
+        if self.fail:
+            raise RuntimeError("Broken kickstart")
+
+    def test_debounce(self):
+        daemon = BuildDaemon(self.check, self.build, debounce=0.5)
+        self.assertFalse(daemon.run_once())
+        time.sleep(0.3)
+        # A new change restarts the debounce period
+        self.commit()
+        self.assertFalse(daemon.run_once())
+        time.sleep(0.3)
+        self.assertFalse(daemon.run_once())
+        time.sleep(0.3)
+        self.assertTrue(daemon.run_once())
+        self.assertEqual(self.builds, [self.check()])
+        self.assertFalse(daemon.run_once())
+        self.assertEqual(daemon.status()["built"], self.check())
+
+    def test_failed_build_not_retried(self):
+        daemon = BuildDaemon(self.check, self.build, debounce=0)
+        self.fail = True
+        self.assertTrue(daemon.run_once())
+        for i in range(5):
+            self.assertFalse(daemon.run_once())
+        self.assertEqual(len(self.builds), 1)
+        self.assertEqual(daemon.status()["failed"], self.check())
+
+        # Retried after a new change or when triggered
+        self.fail = False
+        self.commit()
+        self.assertTrue(daemon.run_once())
+        self.assertEqual(daemon.status()["built"], self.check())
+        self.assertEqual(daemon.status()["failed"], None)
+        daemon.trigger()
+        self.assertTrue(daemon.run_once())
+        self.assertEqual(len(self.builds), 3)
+
+    def test_reverted_change(self):
+        daemon = BuildDaemon(self.check, self.build, debounce=0)
+        self.assertTrue(daemon.run_once())
+        built = self.check()
+        daemon.debounce = 0.3
+        self.commit()
+        self.assertFalse(daemon.run_once())
+        # Upstream goes back to what was built during the debounce period
+        git(["push", "-q", "-f", "origin", "HEAD~1:master"], self.checkout)
+        self.assertEqual(self.check(), built)
+        self.assertFalse(daemon.run_once())
+        time.sleep(0.4)
+        self.assertFalse(daemon.run_once())
+        self.assertEqual(self.builds, [built])
+
+class ControlSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmp_dir, "daemon.sock")
+        self.daemons = []
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            if daemon._server is not None:
+                daemon._server.shutdown()
+                daemon._server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def start(self):
+        daemon = BuildDaemon(lambda: "token", lambda: None, socket_path=self.socket_path)
+        self.daemons.append(daemon)
+        daemon._start_server()
+        return daemon
+
+    def test_no_daemon(self):
+        self.assertRaises(SystemExit, send_command, self.socket_path, "status")
+
+    def test_status(self):
+        self.start()
+        self.assertEqual(send_command(self.socket_path, "status")["state"], "idle")
+
+    def test_daemon_already_running(self):
+        self.start()
+        self.assertRaises(SystemExit, self.start)
+        self.assertEqual(send_command(self.socket_path, "status")["state"], "idle")
+
+    def test_stale_socket(self):
+        # Left behind by a daemon that was killed
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.close()
+        self.assertRaises(SystemExit, send_command, self.socket_path, "status")
+        self.start()
+        self.assertEqual(send_command(self.socket_path, "status")["state"], "idle")
+
+if __name__ == "__main__":
+    unittest.main()
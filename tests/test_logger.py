@@ -0,0 +1,89 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import shutil
+import signal
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builderlib import logger as logger_module
+from builderlib.logger import Logger, configure, flush
+
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stream = open(os.path.join(self.tmp_dir, "log"), "w")
+        configure(stream=self.stream)
+
+    def tearDown(self):
+        configure(stream=sys.stderr)
+        self.stream.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def output(self):
+        with open(self.stream.name, "r") as f:
+            return f.read()
+
+    def test_message(self):
+        Logger().info("Hello")
+        flush()
+        self.assertIn("Hello", self.output())
+
+    def test_forked_child(self):
+        logger = Logger()
+        logger.info("Before fork")
+        pid = os.fork()
+        if pid == 0:
+            # A child stuck waiting for the listener thread fails the test
+            signal.alarm(10)
+            try:
+                logger.info("From the child")
+                flush()
+                self.stream.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        flush()
+        output = self.output()
+        self.assertIn("From the child", output)
+        self.assertEqual(output.count("Before fork"), 1)
+
+    def test_forked_child_without_fork_handler(self):
+        # Python 2 has no os.register_at_fork()
+        backend = logger_module._get_backend()
+        pid = os.fork()
+        if pid == 0:
+            # A child stuck waiting for the listener thread fails the test
+            signal.alarm(10)
+            try:
+                backend.pid = -1
+                Logger().info("Noticed the fork")
+                flush()
+                self.stream.flush()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertIn("Noticed the fork", self.output())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import gzip
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builderlib.prewarm import Prewarmer, rpmvercmp, compare_evr
+
+REPOMD = """<?xml version="1.0" encoding="UTF-8"?>
+<repomd xmlns="http://linux.duke.edu/metadata/repo">
+  <data type="primary">
+    <location href="repodata/primary.xml.gz"/>
+  </data>
+</repomd>
+"""
+
+PACKAGE = """  <package type="rpm">
+    <name>%(name)s</name>
+    <arch>noarch</arch>
+    <version epoch="%(epoch)s" ver="%(ver)s" rel="1"/>
+    <checksum type="sha256">%(checksum)s</checksum>
+    <location href="noarch/%(name)s-%(ver)s.noarch.rpm"/>
+    <format>
+      <rpm:provides><rpm:entry name="%(name)s"/></rpm:provides>
+      <rpm:requires>%(requires)s</rpm:requires>
+    </format>
+  </package>
+"""
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+class MovingCache(object):
+    # Stands in for PackageCache, which moves files with sudo
+    def import_files(self, pairs):
+        for src, dest in pairs:
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            shutil.move(src, dest)
+
+class PrewarmerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.repo_dir = os.path.join(self.tmp_dir, "repo")
+        os.makedirs(os.path.join(self.repo_dir, "repodata"))
+        os.makedirs(os.path.join(self.repo_dir, "noarch"))
+        packages = ""
+        # Older versions are kept in the repository, and listed first
+        for name, epoch, ver, requires in [("foo", "0", "0.9", []), ("foo", "0", "1.0", ["bar"]),
+                                           ("bar", "0", "1.0", []), ("bar", "0", "1.10", []),
+                                           ("bar", "0", "1.9", []), ("unused", "0", "1.0", [])]:
+            data = ("%s %s package\n" % (name, ver)).encode("utf-8")
+            with open(os.path.join(self.repo_dir, "noarch", "%s-%s.noarch.rpm" % (name, ver)), "wb") as f:
+                f.write(data)
+            packages += PACKAGE % {"name": name, "epoch": epoch, "ver": ver,
+                                   "checksum": hashlib.sha256(data).hexdigest(),
+                                   "requires": "".join(['<rpm:entry name="%s"/>' % r for r in requires])}
+        primary = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                   'xmlns:rpm="http://linux.duke.edu/metadata/rpm">\n%s</metadata>\n' % packages)
+        with gzip.open(os.path.join(self.repo_dir, "repodata", "primary.xml.gz"), "wb") as f:
+            f.write(primary.encode("utf-8"))
+        with open(os.path.join(self.repo_dir, "repodata", "repomd.xml"), "w") as f:
+            f.write(REPOMD)
+
+        os.chdir(self.repo_dir)
+        self.server = HTTPServer(("127.0.0.1", 0), QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.kickstart = os.path.join(self.tmp_dir, "maui-x86.ks")
+        with open(self.kickstart, "w") as f:
+            f.write("repo --name=main --baseurl=http://127.0.0.1:%d/\n"
+                    "%%packages\nfoo\n%%end\n" % self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir("/")
+        shutil.rmtree(self.tmp_dir)
+
+    def test_first_run(self):
+        # The caches directory doesn't exist before the first build
+        cache_dir = os.path.join(self.tmp_dir, "buildroot", "cache")
+        prewarmer = Prewarmer(cache_dir, MovingCache(), jobs=2)
+        self.assertEqual(prewarmer.run([(self.kickstart, "x86")]), 2)
+        packages_dir = os.path.join(cache_dir, "x86", "packages", "main", "noarch")
+        self.assertEqual(sorted(os.listdir(packages_dir)),
+                         ["bar-1.10.noarch.rpm", "foo-1.0.noarch.rpm"])
+
+        # Cached packages are not fetched again
+        self.assertEqual(prewarmer.run([(self.kickstart, "x86")]), 0)
+
+    def test_shared_between_caches(self):
+        cache_dir = os.path.join(self.tmp_dir, "cache")
+        prewarmer = Prewarmer(cache_dir, MovingCache())
+        self.assertEqual(prewarmer.run([(self.kickstart, "x86"), (self.kickstart, "x86_64")]), 4)
+        for cache_name in ["x86", "x86_64"]:
+            self.assertTrue(os.path.exists(os.path.join(cache_dir, cache_name, "packages", "main",
+                                                        "noarch", "foo-1.0.noarch.rpm")))
+
+class VersionTest(unittest.TestCase):
+    def test_rpmvercmp(self):
+        for a, b in [("1.0", "2.0"), ("1.9", "1.10"), ("1.0", "1.0.1"), ("1.0", "1.0a"),
+                     ("a", "1"), ("5.5p1", "5.5p10"), ("1.0~rc1", "1.0"), ("1.0~rc1", "1.0~rc2"),
+                     ("1.0", "1.0^git1"), ("1.0^git1", "1.0.1"), ("1.0^git1~pre", "1.0^git1")]:
+            self.assertTrue(rpmvercmp(a, b) < 0, (a, b))
+            self.assertTrue(rpmvercmp(b, a) > 0, (b, a))
+        for a, b in [("1.002", "1.2"), ("1_0", "1.0"), ("1.0", "1.0.")]:
+            self.assertEqual(rpmvercmp(a, b), 0, (a, b))
+
+    def test_epoch(self):
+        self.assertTrue(compare_evr(("1", "1.0", "1"), ("0", "2.0", "1")) > 0)
+        self.assertTrue(compare_evr(("0", "1.0", "2"), ("0", "1.0", "10")) < 0)
+        self.assertEqual(compare_evr((None, "1.0", "1"), ("0", "1.0", "1")), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from builderlib.subprocess_helpers import ProcessRunner
+
+class ProcessRunnerTest(unittest.TestCase):
+    def setUp(self):
+        self.runner = ProcessRunner(log_initiation=False)
+        # Don't wait long for commands ignoring SIGTERM
+        self.runner.KILL_GRACE = 0.5
+        self.lines = []
+
+    def tearDown(self):
+        self.runner.close()
+
+    def add(self, command, **kwargs):
+        return self.runner.add(["sh", "-c", command], stdout_cb=self.lines.append, **kwargs)
+
+    def run_timed(self):
+        start = time.time()
+        results = self.runner.run()
+        return results, time.time() - start
+
+    def test_exit_status_and_output(self):
+        self.add("echo one; echo two >&2; exit 3", stderr_cb=self.lines.append)
+        self.add("kill -9 $$")
+        (failed, killed), elapsed = self.run_timed()
+        self.assertEqual(failed.returncode, 3)
+        self.assertFalse(failed.success)
+        self.assertEqual(sorted(self.lines), ["one", "two"])
+        self.assertEqual(killed.returncode, -9)
+
+    def test_timeout(self):
+        self.add("echo started; sleep 30", timeout=0.3)
+        (result,), elapsed = self.run_timed()
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, -15)
+        self.assertEqual(self.lines, ["started"])
+        self.assertTrue(elapsed < 5)
+
+    def test_sigterm_ignored(self):
+        # Killed with SIGKILL once the grace period is over
+        self.add("trap '' TERM; sleep 30", timeout=0.3)
+        (result,), elapsed = self.run_timed()
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, -9)
+        self.assertTrue(elapsed < 5)
+
+    def test_grandchild_keeps_pipe_open(self):
+        # The command exits right away but a background process keeps
+        # its output open, the whole process group is killed
+        self.add("sleep 30 & echo started", timeout=0.3)
+        (result,), elapsed = self.run_timed()
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(self.lines, ["started"])
+        self.assertTrue(elapsed < 5)
+
+    def test_cancel_from_thread(self):
+        process = self.add("sleep 30 & sleep 30")
+        timer = threading.Timer(0.3, self.runner.cancel, [process])
+        timer.start()
+        (result,), elapsed = self.run_timed()
+        timer.join()
+        self.assertTrue(result.cancelled)
+        self.assertFalse(result.timed_out)
+        self.assertEqual(result.returncode, -15)
+        self.assertTrue(elapsed < 5)
+
+    def test_cancel_queued(self):
+        self.runner.max_jobs = 1
+        self.add("true")
+        queued = self.add("echo never")
+        self.runner.cancel(queued)
+        first, second = self.runner.run()
+        self.assertEqual(first.returncode, 0)
+        self.assertTrue(second.cancelled)
+        self.assertEqual(second.pid, None)
+        self.assertEqual(self.lines, [])
+
+    def test_max_jobs(self):
+        self.runner.max_jobs = 2
+        for i in range(4):
+            self.add("sleep 0.5")
+        results, elapsed = self.run_timed()
+        self.assertEqual([result.returncode for result in results], [0] * 4)
+        # Two at a time, one after the other would take 2 seconds
+        self.assertTrue(1.0 <= elapsed < 1.8)
+
+    def test_rusage(self):
+        self.runner.add([sys.executable, "-c",
+                         "import time\nstart = time.time()\nwhile time.time() - start < 0.3: pass"])
+        (result,), elapsed = self.run_timed()
+        self.assertEqual(result.returncode, 0)
+        self.assertTrue(result.wall_time >= 0.3)
+        self.assertTrue(result.rusage["utime"] + result.rusage["stime"] >= 0.2)
+        self.assertTrue(result.rusage["maxrss"] > 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from builderlib.subprocess_helpers import ChrootSession, ChrootSessionPool, OutputCapture
+
+# Runs commands on this host, see benchmarks/fake
+SDK_CMD = os.path.join(ROOT, "benchmarks", "fake", "mer-sdk-chroot")
+
+class ChrootSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.session = ChrootSession(SDK_CMD)
+        self.output = []
+
+    def tearDown(self):
+        self.session.close()
+
+    def run_command(self, command):
+        return self.session.run([command], self.output.append)
+
+    def test_exit_status(self):
+        self.assertEqual(self.run_command("echo one; echo two"), 0)
+        self.assertEqual(self.output, ["one", "two"])
+        self.assertEqual(self.run_command("exit 3"), 3)
+        self.assertEqual(self.run_command("echo; echo"), 0)
+        self.assertEqual(self.output, ["one", "two", "", ""])
+        self.assertTrue(self.session.alive())
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(self.run_command("printf partial"), 0)
+        self.assertEqual(self.run_command("printf 'crlf\\r\\n'"), 0)
+        self.assertEqual(self.output, ["partial", "crlf"])
+
+    def test_carriage_returns(self):
+        # Progress output redrawing one line comes back line by line
+        command = "i=0; while [ $i -lt 2000 ]; do printf '\\r%d%%' $i; i=$((i+1)); done"
+        self.assertEqual(self.run_command(command), 0)
+        self.assertEqual(len(self.output), 2001)
+        self.assertEqual(self.output[-1], "1999%")
+        self.assertEqual(max(len(line) for line in self.output), 5)
+
+    def test_long_line(self):
+        self.assertEqual(self.run_command("head -c 200000 /dev/zero | tr '\\0' x"), 0)
+        self.assertEqual(len("".join(self.output)), 200000)
+        self.assertEqual(max(len(line) for line in self.output), ChrootSession.MAX_LINE)
+
+    def test_session_dies(self):
+        # Kill the chroot command and everything it started
+        self.assertEqual(self.run_command("echo before; pkill -9 -P $PPID; kill -9 $PPID"), None)
+        # The shell may still report what was killed
+        self.assertEqual(self.output[0], "before")
+        self.assertFalse(self.session.alive())
+        self.assertEqual(self.run_command("true"), None)
+
+    def test_close(self):
+        proc = self.session._proc
+        self.assertEqual(self.run_command("true"), 0)
+        self.session.close()
+        self.assertFalse(self.session.alive())
+        self.assertEqual(proc.returncode, 0)
+        self.session.close()
+
+class ChrootSessionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pool = ChrootSessionPool(SDK_CMD, max_sessions=1)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_reuse(self):
+        capture = OutputCapture(os.path.join(self.tmp_dir, "log"))
+        self.assertTrue(self.pool.run_sync(["echo $$"], log_initiation=False, capture=capture))
+        self.assertTrue(self.pool.run_sync(["echo $$"], log_initiation=False, capture=capture))
+        self.assertFalse(self.pool.run_sync(["false"], fatal_on_error=False, log_initiation=False,
+                                            capture=capture))
+        capture.close()
+        # Both commands ran in the same shell
+        first, second = list(capture.tail)
+        self.assertEqual(first, second)
+
+    def test_dead_session_replaced(self):
+        capture = OutputCapture(os.path.join(self.tmp_dir, "log"))
+        self.assertFalse(self.pool.run_sync(["pkill -9 -P $PPID; kill -9 $PPID"], fatal_on_error=False,
+                                            log_initiation=False, capture=capture))
+        self.assertTrue(self.pool.run_sync(["echo alive"], log_initiation=False, capture=capture))
+        capture.close()
+        self.assertEqual(capture.tail[-1], "alive")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+# vim: et:ts=4:sw=4
+#
+# Copyright (C) 2014 Pier Luigi Fiorini <pierluigi.fiorini@gmail.com>
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place - Suite 330,
+# Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from builderlib.workers import WorkerPool, RemoteWorker, WorkerError, start_local_workers
+
+# Fake SDK chroot, sudo and mic, see benchmarks/fake
+FAKE_DIR = os.path.join(ROOT, "benchmarks", "fake")
+SDK_CMD = os.path.join(FAKE_DIR, "mer-sdk-chroot")
+SECRET = "secret"
+
+class WorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ["PATH"] = FAKE_DIR + ":" + os.environ["PATH"]
+        os.environ["BENCH_IMAGE_SIZE"] = "8M"
+        os.environ["BENCH_IMAGE_DATA"] = "1"
+        os.environ["BENCH_PACKAGES"] = "0"
+        self.kickstart = os.path.join(self.tmp_dir, "maui.ks")
+        with open(self.kickstart, "w") as f:
+            f.write("# Kickstart file\n")
+        self.target = {"name": "maui", "cache": "x86"}
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def start_workers(self, count):
+        processes, addresses = start_local_workers(count, SDK_CMD, os.path.join(self.tmp_dir, "workers"),
+                                                   SECRET)
+        self.processes.extend(processes)
+        return addresses
+
+    def test_build(self):
+        pool = WorkerPool(self.start_workers(1), SECRET)
+        dest = os.path.join(self.tmp_dir, "maui")
+        pool.build(self.target, self.kickstart, dest)
+        st = os.stat(os.path.join(dest, "maui.raw"))
+        self.assertEqual(st.st_size, 8 * 1024 * 1024)
+        # Only the MiB of data is allocated
+        self.assertTrue(st.st_blocks * 512 < 2 * 1024 * 1024)
+        self.assertEqual(st.st_mode & 0o777, 0o644)
+
+    def test_worker_dies(self):
+        os.environ["BENCH_MIC_SECONDS"] = "2"
+        pool = WorkerPool(self.start_workers(2), SECRET)
+        # The first worker takes the job and is killed while building
+        timer = threading.Timer(0.5, self.processes[0].terminate)
+        timer.start()
+        dest = os.path.join(self.tmp_dir, "maui")
+        pool.build(self.target, self.kickstart, dest)
+        timer.join()
+        self.assertTrue(os.path.isfile(os.path.join(dest, "maui.raw")))
+        self.assertFalse(pool.workers[0].alive)
+        self.assertTrue(pool.workers[1].alive)
+
+class RemoteWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, "dest", "maui")
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.worker = RemoteWorker("127.0.0.1:%d" % self.server.getsockname()[1], SECRET)
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def reply(self, files):
+        # Answer one build request with @files, a list of entries and contents
+        def serve():
+            conn, address = self.server.accept()
+            rfile = conn.makefile("rb")
+            rfile.readline()
+            result = {"type": "result", "success": True, "files": [entry for entry, data in files]}
+            conn.sendall((json.dumps(result) + "\n").encode("utf-8"))
+            for entry, data in files:
+                conn.sendall(data)
+            conn.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        try:
+            self.worker.build({"name": "maui", "cache": "x86"}, "", self.dest)
+        finally:
+            thread.join()
+
+    def test_paths_outside_dest(self):
+        for path in ("../escaped", "/tmp/escaped", "a/../../escaped", ""):
+            entry = {"path": path, "size": 1, "mode": 0o644}
+            self.assertRaises(WorkerError, self.reply, [(entry, b"x")])
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+    def test_mode_masked(self):
+        self.reply([({"path": "sub/maui.raw", "size": 1, "mode": 0o4777}, b"x")])
+        st = os.stat(os.path.join(self.dest, "sub", "maui.raw"))
+        self.assertEqual(st.st_mode & 0o7777, 0o777)
+
+    def test_sparse(self):
+        data = b"\0" * 65536 + b"x" + b"\0" * 65536
+        self.reply([({"path": "maui.raw", "size": len(data), "mode": 0o644}, data)])
+        filename = os.path.join(self.dest, "maui.raw")
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), data)
+        self.assertTrue(os.stat(filename).st_blocks * 512 < len(data))
+
+if __name__ == "__main__":
+    unittest.main()